@@ -1,54 +1,78 @@
 #!/usr/bin/python3
 
-from PyQt5.QtCore import Qt, pyqtSignal
-from PyQt5.QtGui import QPainter, QPalette
-from PyQt5.QtWidgets import (QApplication, QCheckBox, QComboBox,
+import importlib.util
+import os
+import time
+from collections import deque
+
+from frame_stats import frameStats, phaseTimer
+
+# Started before the heavier imports, so they show up in the startup report
+startup = phaseTimer()
+
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal  # noqa: E402
+from PyQt5.QtGui import QPainter, QPalette  # noqa: E402
+from PyQt5.QtWidgets import (QApplication, QCheckBox, QComboBox,  # noqa: E402
                              QDoubleSpinBox, QFormLayout, QHBoxLayout, QLabel,
                              QLineEdit, QPushButton, QSlider, QSpinBox,
                              QTabWidget, QVBoxLayout, QWidget)
 
-from picamera2 import Picamera2
-from picamera2.encoders import H264Encoder, Quality
-from picamera2.outputs import FfmpegOutput, FileOutput
-from picamera2.previews.qt import QGlPicamera2
-
-from sliders import logControlSlider, controlSlider
-
-try:
-    import cv2
-    cv_present = True
-except ImportError:
-    cv_present = False
+from picamera2 import Picamera2  # noqa: E402
+from picamera2.encoders import H264Encoder, Quality  # noqa: E402
+from picamera2.outputs import FfmpegOutput, FileOutput  # noqa: E402
+from picamera2.previews.qt import QGlPicamera2  # noqa: E402
+
+from bracket import bracket_exposures, bracketScheduler  # noqa: E402
+from controls import controlWriter, cropSmoother, ignore_controls, implemented_controls  # noqa: E402
+from detector import detectorStage, onnxBackend, onnx_present, stubBackend  # noqa: E402
+from hdr import clear_responses, hdrBracket, hdrEngine, merge_methods, response_key  # noqa: E402
+from info import infoTab, metadataFeed  # noqa: E402
+from motion import lores_size_for, motionDetector  # noqa: E402
+from presets import convergenceWatch, delete_preset, list_presets, load_preset, save_preset  # noqa: E402
+from recorder import metadataRecorder  # noqa: E402
+from recording import activityFrameRate, adaptiveBitrate, eventOutput, indexOutput, index_path, segmentedOutput  # noqa: E402
+from sensor_modes import load_sensor_modes  # noqa: E402
+from sliders import logControlSlider, controlSlider  # noqa: E402
+from writer import writerPool  # noqa: E402
+from zsl import zslRing  # noqa: E402
+
+import numpy as np  # noqa: E402
+
+# Only check OpenCV is there for now, it is imported when an HDR capture first needs it
+cv_present = importlib.util.find_spec("cv2") is not None
+if not cv_present:
     print("OpenCV not found - HDR not available")
-import threading
 
-import numpy as np
+startup.mark("imports")
 
 
 def post_callback(request):
-    # Read the metadata we get back from every request
-    metadata = request.get_metadata()
-    # Put Awb to the end, as they only flash up sometimes
-    sorted_metadata = sorted(metadata.items(), key=lambda x: x[0] if "Awb" not in x[0] else f"Z{x[0]}")
-    # And print everything nicely
-    pretty_metadata = []
-    for k, v in sorted_metadata:
-        row = ""
-        try:
-            iter(v)
-            if k == "ColourCorrectionMatrix":
-                matrix = np.around(np.reshape(v, (-1, 3)), decimals=2)
-                row = f"{k}:\n{matrix}"
-            else:
-                row_data = [f'{x:.2f}' if type(x) is float else f'{x}' for x in v]
-                row = f"{k}: ({', '.join(row_data)})"
-        except TypeError:
-            if type(v) is float:
-                row = f"{k}: {v:.2f}"
-            else:
-                row = f"{k}: {v}"
-        pretty_metadata.append(row)
-    info_tab.setText('\n'.join(pretty_metadata))
+    # Runs on the camera thread for every frame, so only hands things on
+    global preset_watch
+    with frame_stats.timed("post_callback"):
+        # Whatever the tabs changed since the last frame goes out in one go
+        crop_smoother.step()
+        control_writer.flush()
+        metadata = request.get_metadata()
+        frame_stats.frame(metadata)
+        if preset_watch is not None and preset_watch.frame(metadata):
+            preset_watch = None
+        metadata_feed.push(metadata)
+        metadata_recorder.append(metadata)
+        # Only copies the lores frame if the detector is free
+        motion_detector.submit(request)
+        detector_stage.submit(request)
+
+
+def show_metadata():
+    # The GUI side of post_callback, at most metadata_feed.rate times a second
+    metadata = metadata_feed.take()
+    if metadata is None:
+        return
+    if startup_pending:
+        report_startup()
+    if info_tab.isVisible():
+        info_tab.widget.update_rows(metadata)
 
     # Set values from the metadata
     if not aec_tab.exposure_time.isEnabled():
@@ -62,9 +86,19 @@ def post_callback(request):
     vid_tab.frametime = metadata["FrameDuration"]
 
 
+# Set up the HDR workers before the camera starts any threads
+hdr_engine = hdrEngine()
+if cv_present:
+    hdr_engine.start()
+startup.mark("hdr workers")
+
 # Set up camera and application
 picam2 = Picamera2()
 picam2.post_callback = post_callback
+startup.mark("camera open")
+# The sensor modes, from the cache unless this camera and library are new to it
+modes_cached = load_sensor_modes(picam2)
+startup.mark("sensor modes")
 lores_size = picam2.sensor_resolution
 while lores_size[0] > 1600:
     lores_size = (lores_size[0] // 2 & ~1, lores_size[1] // 2 & ~1)
@@ -73,20 +107,76 @@ picam2.still_configuration = picam2.create_still_configuration(
     **still_kwargs,
 )
 picam2.configure("still")
-# Read the sensor modes
-_ = picam2.sensor_modes
+image_writer = writerPool(picam2)
+control_writer = controlWriter(picam2)
+# The configuration the camera is running, and the full ScalerCrop each one has had
+active_config = None
+config_crops = {}
+switch_stats = {"switches": 0, "skipped": 0, "times": deque(maxlen=50)}
+_, scaler_crop, _ = picam2.camera_controls['ScalerCrop']
+crop_smoother = cropSmoother(control_writer, scaler_crop)
+# Counts frames until an applied preset shows up in the metadata
+preset_watch = None
+# The pre-trigger buffer while event recording is running
+event_output = None
+record_index = None
+bitrate_control = None
+frame_rate_control = None
+zsl_ring = zslRing(picam2)
+motion_detector = motionDetector()
+detector_stage = detectorStage(stubBackend())
+startup.mark("configure")
 
 app = QApplication([])
+metadata_feed = metadataFeed()
+frame_stats = frameStats()
+metadata_recorder = metadataRecorder()
+
+
+def config_snapshot(name):
+    # Everything that makes up a configuration, so an unchanged one can be recognised
+    return name, repr(getattr(picam2, f"{name}_configuration").make_dict())
 
 
 def switch_config(new_config):
-    print("Switching to", new_config)
-    # Stop and change config
-    picam2.stop()
-    picam2.configure(new_config)
-    update_controls()
-    picam2.start()
-    update_controls()
+    global active_config
+    start = time.perf_counter()
+    snapshot = config_snapshot(new_config)
+    if snapshot == active_config:
+        # Already running exactly this, so there's nothing to stop and restart
+        switch_stats["skipped"] += 1
+        print("Already in", new_config)
+    else:
+        print("Switching to", new_config)
+        # The ZSL ring waits on frames, so must let go before the camera stops
+        zsl_ring.stop()
+        # Stop and change config
+        picam2.stop()
+        picam2.configure(new_config)
+        # The full image only changes with the configuration, so is looked up once here
+        active_config = snapshot
+        config_crops[snapshot] = picam2.camera_controls['ScalerCrop'][1]
+        # Controls set before starting are applied with the first frames
+        control_writer.forget()
+        update_controls()
+        control_writer.flush()
+        picam2.start()
+        switch_stats["switches"] += 1
+        switch_stats["times"].append(time.perf_counter() - start)
+    if zsl_ring.enabled and new_config == "still":
+        zsl_ring.start()
+    pic_tab.switch_label.setText(
+        f"Last switch {(time.perf_counter() - start) * 1000:.0f}ms, "
+        f"{switch_stats['switches']} switches, {switch_stats['skipped']} skipped"
+    )
+
+
+def full_image():
+    # The full ScalerCrop of the running configuration, as switch_config cached it
+    crop = config_crops.get(active_config)
+    if crop is None:
+        crop = picam2.camera_controls['ScalerCrop'][1]
+    return crop
 
 
 def update_controls():
@@ -94,7 +184,7 @@ def update_controls():
     global scaler_crop
 
     # Fix aspect ratio of the pan/zoom
-    _, full_img, _ = picam2.camera_controls['ScalerCrop']
+    full_img = full_image()
     ar = full_img[2] / full_img[3]
     new_scaler_crop = list(scaler_crop)
     new_scaler_crop[3] = int(new_scaler_crop[2] / ar)
@@ -109,8 +199,7 @@ def update_controls():
     scaler_crop = tuple(new_scaler_crop)
 
     # Update controls
-    with picam2.controls as controls:
-        controls.ScalerCrop = scaler_crop
+    crop_smoother.jump(scaler_crop)
     aec_tab.aec_update()
     aec_tab.awb_update()
     vid_tab.vid_update()
@@ -135,33 +224,145 @@ def on_rec_button_clicked():
 
 
 def on_vid_button_clicked():
-    global recording
-    if not recording:
+    global recording, event_output, record_index
+    if not recording and vid_tab.record_mode.currentText() == "Event Clips":
+        # Encode all the time, but only keep what comes just before and after a trigger. A
+        # keyframe every second lets clips start close to pre_seconds before the trigger.
+        mode_tabs.setEnabled(False)
+        encoder = H264Encoder(iperiod=vid_tab.framerate.value())
+        event_output = eventOutput(
+            vid_tab.filename.text() if vid_tab.filename.text() else "events",
+            vid_tab.pre_seconds.value(), vid_tab.post_seconds.value(), vid_tab.buffer_mb.value() * 2**20,
+            on_clip=vid_tab.clip_done.emit
+        )
+        start_recording(encoder, [event_output], os.path.join(event_output.directory, "events"))
+        event_button.setEnabled(True)
+        rec_button.setText("Stop event recording")
+        recording = True
+    elif not recording and vid_tab.record_mode.currentText() == "Segmented":
+        # One encoder for the whole recording, rolling to a new file at a keyframe. A keyframe
+        # every second keeps each segment close to the length asked for.
+        mode_tabs.setEnabled(False)
+        encoder = H264Encoder(iperiod=vid_tab.framerate.value())
+        output = segmentedOutput(
+            vid_tab.filename.text() if vid_tab.filename.text() else "test",
+            vid_tab.segment_minutes.value() * 60, vid_tab.segment_mb.value() * 2**20,
+            on_segment=vid_tab.segment_done.emit, encoder=encoder
+        )
+        start_recording(encoder, [output], output.name)
+        rec_button.setText("Stop recording")
+        recording = True
+    elif not recording:
         # Start video capture
         mode_tabs.setEnabled(False)
         encoder = H264Encoder()
+        filename = f"{vid_tab.filename.text() if vid_tab.filename.text() else 'test'}.{vid_tab.filetype.currentText()}"
         if vid_tab.filetype.currentText() in ["mp4", "mkv", "mov", "ts", "avi"]:
-            output = FfmpegOutput(
-                f"{vid_tab.filename.text() if vid_tab.filename.text() else 'test'}.{vid_tab.filetype.currentText()}"
-            )
+            output = FfmpegOutput(filename)
+        elif vid_tab.activity_rate.isChecked():
+            # Raw H.264 has no timestamps of its own, and the frame rate will vary
+            output = FileOutput(filename, pts=f"{os.path.splitext(filename)[0]}_pts.txt")
         else:
-            output = FileOutput(
-                f"{vid_tab.filename.text() if vid_tab.filename.text() else 'test'}.{vid_tab.filetype.currentText()}"
-            )
-        picam2.start_encoder(encoder, output, vid_tab.quality)
+            output = FileOutput(filename)
+        # Keyframe offsets and events go in a sidecar, so the recording can be seeked later
+        record_index = indexOutput(index_path(filename), encoder)
+        start_recording(encoder, [output, record_index], os.path.splitext(filename)[0])
         rec_button.setText("Stop recording")
         recording = True
     else:
         # Stop video capture
         picam2.stop_encoder()
+        stop_recording_controls()
+        if record_index is not None:
+            vid_tab.record_stats.setText(
+                f"Indexed {record_index.keyframes} keyframes, {record_index.events} events in {record_index.filename}"
+            )
+        event_output = None
+        record_index = None
+        event_button.setEnabled(False)
         rec_button.setText("Start recording")
         mode_tabs.setEnabled(True)
         recording = False
 
 
+def start_recording(encoder, outputs, name):
+    # Start the encoder, with the motion score driving its bitrate and the camera frame rate
+    # if asked for
+    global bitrate_control, frame_rate_control
+    if vid_tab.adaptive_bitrate.isChecked():
+        bitrate_control = adaptiveBitrate(
+            encoder, int(vid_tab.min_mbps.value() * 1e6), int(vid_tab.max_mbps.value() * 1e6),
+            log=f"{name}_bitrate.csv"
+        )
+        # An explicit bitrate takes the place of the quality preset
+        encoder.bitrate = bitrate_control.max_bitrate
+        outputs = outputs + [bitrate_control]
+    if vid_tab.activity_rate.isChecked():
+        frame_rate_control = activityFrameRate(
+            lambda fps: control_writer.set({"FrameRate": fps}),
+            vid_tab.framerate.value(), vid_tab.idle_framerate.value(), vid_tab.idle_after.value(),
+            motion_detector.min_area
+        )
+        outputs = outputs + [frame_rate_control]
+    if bitrate_control is not None or frame_rate_control is not None:
+        motion_detector.on_score = on_motion_score
+    picam2.start_encoder(encoder, outputs, quality=vid_tab.quality)
+
+
+def on_motion_score(score, timestamp):
+    # Every frame's motion score, from the motion detector's thread
+    if bitrate_control is not None:
+        bitrate_control.update(score, timestamp)
+    if frame_rate_control is not None:
+        frame_rate_control.update(score, timestamp)
+
+
+def stop_recording_controls():
+    global bitrate_control, frame_rate_control
+    motion_detector.on_score = None
+    report = []
+    if bitrate_control is not None:
+        summary = bitrate_control.summary
+        if summary is not None:
+            report.append(
+                f"Adaptive bitrate: {summary['mb_per_hour']:.0f}MB/hour, {summary['saved'] * 100:.0f}% below the maximum"
+            )
+    if frame_rate_control is not None:
+        stats = frame_rate_control.stats
+        report.append(
+            f"Activity frame rate: {stats['frames']} frames, {stats['skipped']} skipped,"
+            f" about {stats['saved_bytes'] / 2**20:.1f}MB saved"
+        )
+    if report:
+        vid_tab.record_stats.setText("\n".join(report))
+    bitrate_control = None
+    frame_rate_control = None
+
+
+def mark_event(reason, timestamp=None):
+    # Note an event in the index of the recording in progress, timestamp being a SensorTimestamp
+    if record_index is None:
+        return
+    record_index.mark(reason, timestamp // 1000 if timestamp is not None else None)
+
+
+def trigger_event(reason):
+    # Save a clip from just before now, if event recording is running
+    if event_output is None:
+        return False
+    event_output.trigger(reason)
+    return True
+
+
 def on_pic_button_clicked():
+    if zsl_ring.running and not pic_tab.hdr.isChecked():
+        # Take the frame the camera already had when the button was pressed
+        request = zsl_ring.take(time.monotonic_ns())
+        if request is not None:
+            save_capture(request)
+            return
     # Send capture request
-    if pic_tab.preview_check.isChecked() and rec_button.isEnabled():
+    if pic_tab.use_preview and rec_button.isEnabled():
         switch_config("still")
         picam2.capture_request(signal_function=qpicamera2.signal_done)
     else:
@@ -185,160 +386,170 @@ def on_mode_change(i):
         hide_button.setEnabled(True)
     else:
         rec_button.setText("Take photo")
-        switch_config("preview" if pic_tab.preview_check.isChecked() else "still")
+        switch_config("preview" if pic_tab.use_preview else "still")
         pic_tab.apply_settings()
 
 
 def capture_done(job):
+    with frame_stats.timed("capture_done"):
+        handle_capture(job)
+
+
+def handle_capture(job):
     # Here's the request we captured. But we must always release it when we're done with it!
     if not pic_tab.hdr.isChecked():
         # Save the normal image
-        request = picam2.wait(job)
-        if pic_tab.filetype.currentText() == "raw":
-            request.save_dng(
-                f"{pic_tab.filename.text() if pic_tab.filename.text() else 'test'}.dng"
-            )
-        else:
-            request.save(
-                "main", f"{pic_tab.filename.text() if pic_tab.filename.text() else 'test'}.{pic_tab.filetype.currentText()}"
-            )
-        request.release()
+        save_capture(picam2.wait(job))
         rec_button.setEnabled(True)
         mode_tabs.setEnabled(True)
-        if pic_tab.preview_check.isChecked():
+        if pic_tab.use_preview:
             switch_config("preview")
     else:
-        # HDR Capture
-        global hdr_imgs  # noqa
+        # HDR Capture. This first frame picks the exposures, then the scheduler collects the rest
+        global hdr_imgs, hdr_bracket  # noqa
         request = picam2.wait(job)
         new_img = request.make_array("main")
-        new_cv_img = cv2.cvtColor(new_img, cv2.COLOR_RGB2BGR)
         metadata = request.get_metadata()
         request.release()
         new_exposure = metadata["ExposureTime"]
-        if hdr_imgs["exposures"] is None:
-            # Pick what exposures to use
-            pic_tab.pic_update()
-            e_log = np.log2(new_exposure)
-            max_e = np.log2(pic_tab.pic_dict["FrameDurationLimits"][1])
-            below = pic_tab.stops_hdr_below.value()
-            above = pic_tab.stops_hdr_above.value()
-            if e_log + 1 > max_e:
-                above = max_e - e_log
-                print("Desired exposure too long, reducing", e_log + 1, max_e, above)
-            # list(set()) to ensure uniqueness
-            hdr_imgs["exposures"] = {"all": list(set(np.logspace(
-                e_log - below, e_log + above, pic_tab.num_hdr.value(),
-                base=2.0, dtype=np.integer
-            )))}
-            # Remove any 0 exposures
-            if 0 in hdr_imgs["exposures"]["all"]:
-                i = hdr_imgs["exposures"]["all"].index(0)
-                hdr_imgs["exposures"]["all"][i] = picam2.camera_controls["ExposureTime"][0]
-            hdr_imgs["exposures"]["all"].sort()
-            hdr_imgs["exposures"]["left"] = hdr_imgs["exposures"]["all"].copy()
-            hdr_imgs["exposures"]["number"] = 0
-            print("Picked exposures", hdr_imgs)
-            # Disable aec so it doesn't adjust gains
-            aec_tab.aec_check.setChecked(False)
-            # Save first image
-            cv2.imwrite(
-                f"{pic_tab.filename.text() if pic_tab.filename.text() else 'test'}_base.{pic_tab.filetype.currentText()}",
-                new_cv_img
-            )
-        else:
-            # Find which exposure time has been captured
-            nearest_exposure = min(hdr_imgs["exposures"]["all"], key=lambda x: abs(x - new_exposure))
-            if nearest_exposure == hdr_imgs["exposures"]["left"][0]:
-                # This is an image we want
-                hdr_imgs[new_exposure] = new_cv_img
-                hdr_imgs["exposures"]["number"] += 1
-                hdr_imgs["exposures"]["left"].pop(0)
-                print("Taken", hdr_imgs["exposures"]["number"], "images")
-            else:
-                # Ignore this image
-                print("Waiting for exposure switch from", new_exposure, "to", hdr_imgs["exposures"]["left"][0])
-        if hdr_imgs["exposures"]["number"] == len(hdr_imgs["exposures"]["all"]):
-            print(f"All {len(hdr_imgs) - 1} HDR exposures captured, dispatching thread to process them")
-            print("Captured exposures", list(hdr_imgs.keys())[1:])
-            print("Desired exposures", hdr_imgs["exposures"]["all"])
-            thread = threading.Thread(target=process_hdr, daemon=True)
-            thread.start()
-            aec_tab.aec_check.setChecked(True)
-            mode_tabs.setEnabled(True)
-            rec_button.setEnabled(True)
-            pic_tab.hdr.setChecked(False)
-            pic_tab.hdr.setEnabled(False)
-            if pic_tab.preview_check.isChecked():
-                switch_config("preview")
-            return
-        else:
-            # Set next exposure again incase it didn't apply
-            picam2.controls.ExposureTime = hdr_imgs["exposures"]["left"][0]
-            # Take next image
-            thread = threading.Thread(target=rec_button.clicked.emit, daemon=True)
-            thread.start()
-
-
-def process_hdr():
-    global hdr_imgs
-    del hdr_imgs["exposures"]
-    img_list = []
-    exposures = []
-    for k, v in hdr_imgs.items():
-        img_list.append(v)
-        exposures.append(int(k))
-    exposures = np.array(exposures, dtype=np.float32)
+        # Pick what exposures to use
+        pic_tab.pic_update()
+        hdr_imgs["exposures"] = {"all": bracket_exposures(
+            new_exposure, pic_tab.stops_hdr_below.value(), pic_tab.stops_hdr_above.value(),
+            pic_tab.num_hdr.value(), picam2.camera_controls["ExposureTime"][0],
+            pic_tab.pic_dict["FrameDurationLimits"][1]
+        )}
+        # The gain stays put for the whole bracket, and picks the response curve to use
+        hdr_imgs["exposures"]["gain"] = metadata["AnalogueGain"]
+        print("Picked exposures", hdr_imgs)
+        # Frames are converted straight into the bracket the merge workers will read
+        hdr_bracket = hdrBracket(len(hdr_imgs["exposures"]["all"]), new_img.shape)
+        # Disable aec so it doesn't adjust gains, before the scheduler sets any exposures
+        aec_tab.aec_check.setChecked(False)
+        control_writer.flush()
+        # Save first image
+        import cv2
+        image_writer.write_array(
+            cv2.cvtColor(new_img, cv2.COLOR_RGB2BGR),
+            f"{pic_tab.filename.text() if pic_tab.filename.text() else 'test'}_base.{pic_tab.filetype.currentText()}",
+            done=pic_tab.write_done.emit
+        )
+        # The scheduler needs every frame to itself
+        zsl_ring.stop()
+        scheduler = bracketScheduler(
+            picam2, hdr_imgs["exposures"]["all"], store_bracket_frame, done=pic_tab.bracket_done.emit
+        )
+        scheduler.start()
+
+
+def save_capture(request):
+    # The writers copy what they need and release the request, then encode in the background
+    image_writer.write_request(request, pic_tab.outputs, done=pic_tab.write_done.emit)
+
+
+def store_bracket_frame(i, request):
+    # Called on the scheduler's thread for each wanted frame
+    import cv2
+    cv2.cvtColor(request.make_array("main"), cv2.COLOR_RGB2BGR, dst=hdr_bracket.stack[i])
+
+
+def on_bracket_done(scheduler):
+    # Back on the GUI thread once the scheduler has finished
+    global hdr_imgs, hdr_bracket
+    pic_tab.bracket_stats.setText(
+        f"{scheduler.frames} frames, {scheduler.wasted} wasted, {scheduler.elapsed:.2f}s"
+    )
+    if scheduler.complete:
+        print(f"All {len(scheduler.taken)} HDR exposures captured, dispatching them for processing")
+        print("Captured exposures", [t[0] for t in scheduler.taken])
+        print("Desired exposures", hdr_imgs["exposures"]["all"])
+        process_hdr(scheduler)
+    else:
+        print("Giving up on HDR bracket, missing exposures", [scheduler.exposures[i] for i in scheduler.missing])
+        hdr_bracket.release()
+        hdr_bracket = None
+        hdr_imgs = {"exposures": None}
+    # The scheduler set exposures without the control writer knowing
+    control_writer.forget()
+    aec_tab.aec_check.setChecked(True)
+    mode_tabs.setEnabled(True)
+    rec_button.setEnabled(True)
+    pic_tab.hdr.setChecked(False)
+    if pic_tab.use_preview:
+        switch_config("preview")
+    elif zsl_ring.enabled:
+        zsl_ring.start()
+
+
+def process_hdr(scheduler):
+    global hdr_imgs, hdr_bracket
+    gain = hdr_imgs["exposures"]["gain"]
+    # Exposure times the frames were actually taken at, in the order they sit in the bracket
+    exposures = np.array([t[0] for t in scheduler.taken], dtype=np.float32)
     exposures /= 1e6
+    bracket = hdr_bracket
+    hdr_imgs = {"exposures": None}
+    hdr_bracket = None
     print("Ready")
-    tonemap = cv2.createTonemap(gamma=pic_tab.hdr_gamma.value())
     pic_tab.hdr_label.setText("HDR (Processing)")
 
-    mean_image = np.average(np.array(img_list), axis=0)
-    mean_8bit = mean_image.astype('uint8')
-    cv2.imwrite(
-        f"{pic_tab.filename.text() if pic_tab.filename.text() else 'test'}_mean.{pic_tab.filetype.currentText()}",
-        mean_8bit
-    )
-    del mean_image, mean_8bit
-    print("Mean Done")
-
-    merge_debevec = cv2.createMergeDebevec()
-    hdr_debevec = merge_debevec.process(img_list, times=exposures.copy())
-    res_debevec = tonemap.process(hdr_debevec.copy())
-    res_debevec_8bit = np.clip(res_debevec * 255, 0, 255).astype('uint8')
-    cv2.imwrite(
-        f"{pic_tab.filename.text() if pic_tab.filename.text() else 'test'}_debevec.{pic_tab.filetype.currentText()}",
-        res_debevec_8bit
-    )
-    del merge_debevec, hdr_debevec, res_debevec, res_debevec_8bit
-    print("Debevec Done")
-
-    merge_robertson = cv2.createMergeRobertson()
-    hdr_robertson = merge_robertson.process(img_list, times=exposures.copy())
-    res_robertson = tonemap.process(hdr_robertson.copy())
-    res_robertson_8bit = np.clip(res_robertson * 255, 0, 255).astype('uint8')
-    cv2.imwrite(
-        f"{pic_tab.filename.text() if pic_tab.filename.text() else 'test'}_robertson.{pic_tab.filetype.currentText()}",
-        res_robertson_8bit
-    )
-    del merge_robertson, hdr_robertson, res_robertson, res_robertson_8bit
-    print("Robertson Done")
-
-    merge_mertens = cv2.createMergeMertens()
-    res_mertens = merge_mertens.process(img_list)
-    res_mertens_8bit = np.clip(res_mertens * 255, 0, 255).astype('uint8')
-    cv2.imwrite(
-        f"{pic_tab.filename.text() if pic_tab.filename.text() else 'test'}_mertens.{pic_tab.filetype.currentText()}",
-        res_mertens_8bit
+    name = pic_tab.filename.text() if pic_tab.filename.text() else 'test'
+    filenames = {method: f"{name}_{method}.{pic_tab.filetype.currentText()}" for method in merge_methods}
+    # The engine now owns the bracket, so the next one can be taken straight away
+    hdr_engine.process(
+        bracket, exposures, pic_tab.hdr_methods, pic_tab.hdr_gamma.value(), filenames, done=pic_tab.hdr_done.emit,
+        max_memory=pic_tab.hdr_max_memory, key=pic_tab.response_key(gain)
     )
-    del merge_mertens, res_mertens, res_mertens_8bit
-    print("Mertens Done")
 
-    print("Saved All HDR Images")
-    hdr_imgs = {"exposures": None}
-    pic_tab.hdr.setEnabled(True)
+
+def set_combo(box, text):
+    # Select the item with this text, if there is one
+    i = box.findText(text) if text is not None else -1
+    if i >= 0:
+        box.setCurrentIndex(i)
+
+
+def current_preset():
+    # Every control the tabs set, and the still and video settings
+    controls = {}
+    controls.update(aec_tab.aec_dict)
+    controls.update(aec_tab.awb_dict)
+    controls.update(img_tab.build().img_dict)
+    controls.update(other_tab.build().other_dict)
+    return {"controls": controls, "still": pic_tab.preset, "video": vid_tab.preset}
+
+
+def apply_preset(preset, done=None):
+    # Configuration changes come first, as a switch resends every control anyway. Then all the
+    # tabs' controls are held back and go out together as one set_controls, so no frame ever
+    # has half a preset. Returns the seconds taken to get that far.
+    global preset_watch
+    start = time.perf_counter()
+    pic_tab.apply_preset(preset.get("still", {}))
+    vid_tab.apply_preset(preset.get("video", {}))
+    if recording:
+        print("Recording, so not changing the configuration")
+    elif mode_tabs.currentIndex():
+        vid_tab.apply_settings()
+    else:
+        pic_tab.apply_settings()
+    controls = preset.get("controls", {})
+    with control_writer.hold():
+        aec_tab.apply_controls(controls)
+        img_tab.build().apply_controls(controls)
+        other_tab.build().apply_controls(controls)
+    # done(frames, seconds, converged) once the metadata shows the preset has taken
+    preset_watch = convergenceWatch(controls, done=done)
+    return time.perf_counter() - start
+
+
+def hdr_done(timings):
+    if hdr_engine.busy:
+        return
     pic_tab.hdr_label.setText("HDR")
+    pic_tab.hdr_times.setText(", ".join(
+        f"{k} {v:.1f}s/{hdr_engine.peak_memory[k][0] / 2**20:.0f}MB" for k, v in timings.items()
+    ))
 
 
 class panTab(QWidget):
@@ -358,8 +569,14 @@ class panTab(QWidget):
         self.pan_display.updated.connect(lambda: self.zoom_text.setText(
             f"Current Zoom Level: {self.pan_display.zoom_level:.1f}x"))
 
+        self.smooth = QCheckBox("Smooth Pan/Zoom")
+        self.smooth.setChecked(True)
+        self.smooth.stateChanged.connect(
+            lambda: setattr(crop_smoother, "smoothing", 0.35 if self.smooth.isChecked() else 1.0))
+
         self.layout.addRow(self.label)
         self.layout.addRow(self.zoom_text)
+        self.layout.addRow(self.smooth)
         self.layout.addRow(self.pan_display)
         self.layout.setAlignment(self.pan_display, Qt.AlignCenter)
 
@@ -370,7 +587,7 @@ class panZoomDisplay(QWidget):
     def __init__(self):
         super().__init__()
         self.setMinimumSize(201, 151)
-        _, full_img, _ = picam2.camera_controls['ScalerCrop']
+        full_img = full_image()
         self.scale = 200 / full_img[2]
         self.zoom_level_ = 1.0
         self.max_zoom = 7.0
@@ -392,7 +609,7 @@ class panZoomDisplay(QWidget):
     def paintEvent(self, event):
         painter = QPainter()
         painter.begin(self)
-        _, full_img, _ = picam2.camera_controls['ScalerCrop']
+        full_img = full_image()
         self.scale = 200 / full_img[2]
         # Whole frame
         scaled_full_img = [int(i * self.scale) for i in full_img]
@@ -410,7 +627,7 @@ class panZoomDisplay(QWidget):
     def draw_centered(self, pos):
         global scaler_crop
         center = [int(i / self.scale) for i in pos]
-        _, full_img, _ = picam2.camera_controls['ScalerCrop']
+        full_img = full_image()
         w = scaler_crop[2]
         h = scaler_crop[3]
         x = center[0] - w // 2 + full_img[0]
@@ -423,7 +640,7 @@ class panZoomDisplay(QWidget):
         new_scaler_crop[0] = max(new_scaler_crop[0], full_img[0])
         new_scaler_crop[0] = min(new_scaler_crop[0], full_img[0] + full_img[2] - new_scaler_crop[2])
         scaler_crop = tuple(new_scaler_crop)
-        picam2.controls.ScalerCrop = scaler_crop
+        crop_smoother.set_target(scaler_crop)
         self.update()
 
     def mouseMoveEvent(self, event):
@@ -438,7 +655,7 @@ class panZoomDisplay(QWidget):
         if self.zoom_level > self.max_zoom:
             self.zoom_level = self.max_zoom
         factor = 1.0 / self.zoom_level
-        _, full_img, _ = picam2.camera_controls['ScalerCrop']
+        full_img = full_image()
         current_center = (scaler_crop[0] + scaler_crop[2] // 2, scaler_crop[1] + scaler_crop[3] // 2)
         w = int(factor * full_img[2])
         h = int(factor * full_img[3])
@@ -451,7 +668,7 @@ class panZoomDisplay(QWidget):
         new_scaler_crop[0] = max(new_scaler_crop[0], full_img[0])
         new_scaler_crop[0] = min(new_scaler_crop[0], full_img[0] + full_img[2] - new_scaler_crop[2])
         scaler_crop = tuple(new_scaler_crop)
-        picam2.controls.ScalerCrop = scaler_crop
+        crop_smoother.set_target(scaler_crop)
         self.update()
 
     def wheelEvent(self, event):
@@ -570,7 +787,7 @@ class AECTab(QWidget):
         if self.aec_check.isChecked():
             self.aec_apply.setEnabled(False)
         # print(self.aec_dict)
-        picam2.set_controls(self.aec_dict)
+        control_writer.set(self.aec_dict)
 
     def aec_manual_update(self):
         if not self.aec_check.isChecked():
@@ -597,7 +814,30 @@ class AECTab(QWidget):
         self.colour_gain_r.setEnabled(not self.awb_check.isChecked())
         self.colour_gain_b.setEnabled(not self.awb_check.isChecked())
         # print(self.awb_dict)
-        picam2.set_controls(self.awb_dict)
+        control_writer.set(self.awb_dict)
+
+    def apply_controls(self, controls):
+        # Set the widgets from a preset, leaving alone anything it doesn't mention
+        if "AeEnable" in controls:
+            self.aec_check.setChecked(controls["AeEnable"])
+        for name, box in [("AeMeteringMode", self.aec_meter), ("AeConstraintMode", self.aec_constraint),
+                          ("AeExposureMode", self.aec_exposure), ("AwbMode", self.awb_mode)]:
+            if name in controls:
+                box.setCurrentIndex(controls[name])
+        if "ExposureValue" in controls:
+            self.exposure_val.setValue(controls["ExposureValue"])
+        if "ExposureTime" in controls:
+            self.exposure_time.setValue(controls["ExposureTime"])
+        if "AnalogueGain" in controls:
+            self.analogue_gain.setValue(controls["AnalogueGain"])
+        if "AwbEnable" in controls:
+            self.awb_check.setChecked(controls["AwbEnable"])
+        if "ColourGains" in controls:
+            self.colour_gain_r.setValue(controls["ColourGains"][0])
+            self.colour_gain_b.setValue(controls["ColourGains"][1])
+        self.aec_update()
+        self.awb_update()
+        self.aec_apply.setEnabled(False)
 
 
 class IMGTab(QWidget):
@@ -670,7 +910,18 @@ class IMGTab(QWidget):
         self.brightness.setMaximum(picam2.camera_controls["Brightness"][1])
 
         # print(self.img_dict)
-        picam2.set_controls(self.img_dict)
+        control_writer.set(self.img_dict)
+
+    def apply_controls(self, controls):
+        # Set the widgets from a preset, leaving alone anything it doesn't mention
+        sliders = {
+            "Saturation": self.saturation, "Contrast": self.contrast,
+            "Sharpness": self.sharpness, "Brightness": self.brightness,
+        }
+        for name, slider in sliders.items():
+            if name in controls:
+                slider.setValue(controls[name])
+        self.img_update()
 
 
 class otherTab(QWidget):
@@ -680,7 +931,6 @@ class otherTab(QWidget):
         self.layout = QFormLayout()
         self.setLayout(self.layout)
 
-        global implemented_controls, ignore_controls  # noqa
         all_controls = picam2.camera_controls.keys()
         other_controls = []
         for control in all_controls:
@@ -708,10 +958,20 @@ class otherTab(QWidget):
         return ret
 
     def other_update(self):
-        picam2.set_controls(self.other_dict)
+        control_writer.set(self.other_dict)
+
+    def apply_controls(self, controls):
+        for name, widget in self.fields.items():
+            if name in controls:
+                widget.setValue(controls[name])
+        self.other_update()
 
 
 class vidTab(QWidget):
+    # Emitted from the encoder thread as each event clip or segment is finished
+    clip_done = pyqtSignal(str, int, int, str)
+    segment_done = pyqtSignal(object)
+
     def __init__(self):
         super().__init__()
         self.layout = QFormLayout()
@@ -736,6 +996,41 @@ class vidTab(QWidget):
         self.raw_format.addItems([f'{x["format"].format} {x["size"]}, {x["fps"]:.0f}fps' for x in picam2.sensor_modes])
         self.apply_button = QPushButton("Apply")
         self.apply_button.clicked.connect(self.apply_settings)
+        self.record_mode = QComboBox()
+        self.record_mode.addItems(["Continuous", "Event Clips", "Segmented"])
+        self.pre_seconds = QDoubleSpinBox()
+        self.pre_seconds.setRange(0.0, 120.0)
+        self.pre_seconds.setValue(5.0)
+        self.post_seconds = QDoubleSpinBox()
+        self.post_seconds.setRange(1.0, 600.0)
+        self.post_seconds.setValue(10.0)
+        self.buffer_mb = QSpinBox()
+        self.buffer_mb.setRange(4, 1024)
+        self.buffer_mb.setValue(64)
+        self.record_stats = QLabel("")
+        self.clips = 0
+        self.clip_done.connect(self.on_clip_done)
+        self.segment_minutes = QDoubleSpinBox()
+        self.segment_minutes.setRange(0.0, 1440.0)
+        self.segment_minutes.setValue(10.0)
+        self.segment_mb = QSpinBox()
+        self.segment_mb.setRange(0, 100000)
+        self.segment_mb.setValue(0)
+        self.segment_done.connect(self.on_segment_done)
+        self.adaptive_bitrate = QCheckBox()
+        self.min_mbps = QDoubleSpinBox()
+        self.min_mbps.setRange(0.1, 50.0)
+        self.min_mbps.setValue(1.0)
+        self.max_mbps = QDoubleSpinBox()
+        self.max_mbps.setRange(0.1, 50.0)
+        self.max_mbps.setValue(10.0)
+        self.activity_rate = QCheckBox()
+        self.idle_framerate = QDoubleSpinBox()
+        self.idle_framerate.setRange(0.1, 30.0)
+        self.idle_framerate.setValue(1.0)
+        self.idle_after = QDoubleSpinBox()
+        self.idle_after.setRange(1.0, 600.0)
+        self.idle_after.setValue(10.0)
 
         # Cosmetic additions
         resolution = QWidget()
@@ -756,6 +1051,20 @@ class vidTab(QWidget):
 
         self.layout.addRow(self.apply_button)
 
+        self.layout.addRow("Motion Adaptive Bitrate", self.adaptive_bitrate)
+        self.layout.addRow("Still Bitrate/Mbps", self.min_mbps)
+        self.layout.addRow("Motion Bitrate/Mbps", self.max_mbps)
+        self.layout.addRow("Activity Frame Rate", self.activity_rate)
+        self.layout.addRow("Still Frame Rate", self.idle_framerate)
+        self.layout.addRow("Still After/s", self.idle_after)
+        self.layout.addRow("Recording Mode", self.record_mode)
+        self.layout.addRow("Event Pre-Trigger/s", self.pre_seconds)
+        self.layout.addRow("Event Post-Trigger/s", self.post_seconds)
+        self.layout.addRow("Event Buffer/MB", self.buffer_mb)
+        self.layout.addRow("Segment Length/min (0 for no limit)", self.segment_minutes)
+        self.layout.addRow("Segment Size/MB (0 for no limit)", self.segment_mb)
+        self.layout.addRow(self.record_stats)
+
         self.reset()
 
     @property
@@ -785,6 +1094,17 @@ class vidTab(QWidget):
         self.frametime_ = value
         self.actual_framerate.setText(f"Actual Framerate: {1e6 / self.frametime:.1f}fps")
 
+    def on_clip_done(self, filename, frames, size, reason):
+        self.clips += 1
+        self.record_stats.setText(
+            f"{self.clips} clips, last {os.path.basename(filename)} ({reason}, {frames} frames, {size / 2**20:.1f}MB)"
+        )
+
+    def on_segment_done(self, entry):
+        self.record_stats.setText(
+            f"Segment {entry['index']} {entry['filename']}: {entry['frames']} frames, {entry['bytes'] / 2**20:.1f}MB"
+        )
+
     @property
     def vid_dict(self):
         return {
@@ -793,29 +1113,76 @@ class vidTab(QWidget):
 
     def vid_update(self):
         if self.isVisible():
-            picam2.set_controls(self.vid_dict)
+            control_writer.set(self.vid_dict)
         else:
             print("Not setting vid controls when not visible")
 
+    @property
+    def preset(self):
+        return {
+            "filetype": self.filetype.currentText(),
+            "quality": self.quality_box.currentText(),
+            "framerate": self.framerate.value(),
+            "size": [self.resolution_w.value(), self.resolution_h.value()],
+            "raw_format": self.raw_format.currentText(),
+            "adaptive_bitrate": self.adaptive_bitrate.isChecked(),
+            "bitrate_mbps": [self.min_mbps.value(), self.max_mbps.value()],
+            "activity_rate": self.activity_rate.isChecked(),
+            "idle_framerate": self.idle_framerate.value(),
+            "idle_after": self.idle_after.value(),
+        }
+
+    def apply_preset(self, preset):
+        set_combo(self.filetype, preset.get("filetype"))
+        set_combo(self.quality_box, preset.get("quality"))
+        set_combo(self.raw_format, preset.get("raw_format"))
+        if "framerate" in preset:
+            self.framerate.setValue(preset["framerate"])
+        if "size" in preset:
+            self.resolution_w.setValue(preset["size"][0])
+            self.resolution_h.setValue(preset["size"][1])
+        if "adaptive_bitrate" in preset:
+            self.adaptive_bitrate.setChecked(preset["adaptive_bitrate"])
+        if "bitrate_mbps" in preset:
+            self.min_mbps.setValue(preset["bitrate_mbps"][0])
+            self.max_mbps.setValue(preset["bitrate_mbps"][1])
+        if "activity_rate" in preset:
+            self.activity_rate.setChecked(preset["activity_rate"])
+        if "idle_framerate" in preset:
+            self.idle_framerate.setValue(preset["idle_framerate"])
+        if "idle_after" in preset:
+            self.idle_after.setValue(preset["idle_after"])
+
     def reset(self):
         self.quality_box.setCurrentIndex(2)
         self.framerate.setValue(30)
         self.resolution_h.setValue(720)
         self.resolution_w.setValue(1280)
+        main_size = (self.resolution_w.value(), self.resolution_h.value())
         picam2.video_configuration = picam2.create_video_configuration(
-            main={"size": (self.resolution_w.value(), self.resolution_h.value())},
+            main={"size": main_size},
+            lores={"size": lores_size_for(main_size)},
             raw=self.sensor_mode
         )
 
     def apply_settings(self):
+        main_size = (self.resolution_w.value(), self.resolution_h.value())
         picam2.video_configuration = picam2.create_video_configuration(
-            main={"size": (self.resolution_w.value(), self.resolution_h.value())},
+            main={"size": main_size},
+            lores={"size": lores_size_for(main_size)},
             raw=self.sensor_mode
         )
         switch_config("video")
 
 
 class picTab(QWidget):
+    # Emitted from the bracket scheduler's thread, so the result is handled on the GUI thread
+    bracket_done = pyqtSignal(object)
+    # Emitted from the writer threads as each file is finished
+    write_done = pyqtSignal(str, float)
+    # Emitted from the HDR engine's thread with each merge method's time
+    hdr_done = pyqtSignal(object)
+
     def __init__(self):
         super().__init__()
         self.layout = QFormLayout()
@@ -842,6 +1209,17 @@ class picTab(QWidget):
         self.preview_warning = QLabel("WARNING: Preview and Capture modes have different fields of view")
         self.preview_warning.setWordWrap(True)
         self.preview_warning.hide()
+        self.zsl_check = QCheckBox()
+        self.zsl_check.stateChanged.connect(self.apply_settings)
+        self.zsl_size = QSpinBox()
+        self.zsl_size.setRange(1, 4)
+        self.zsl_size.setValue(zsl_ring.size)
+        self.zsl_size.valueChanged.connect(lambda: self.apply_button.setEnabled(True))
+        self.save_lores = QCheckBox()
+        self.save_raw = QCheckBox()
+        self.writer_stats = QLabel("")
+        self.switch_label = QLabel("")
+        self.write_done.connect(self.update_writer_stats)
         self.hdr_label = QLabel("HDR")
         self.hdr = QCheckBox()
         self.hdr.setChecked(False)
@@ -866,6 +1244,21 @@ class picTab(QWidget):
             self.stops_hdr_below.setRange(1, 10)
             self.hdr_gamma = QDoubleSpinBox()
             self.hdr_gamma.setSingleStep(0.1)
+            self.hdr_method_checks = {}
+            for method in merge_methods:
+                self.hdr_method_checks[method] = QCheckBox(method.capitalize())
+                self.hdr_method_checks[method].setChecked(True)
+            self.hdr_times = QLabel("")
+            self.bracket_stats = QLabel("")
+            self.hdr_tiled = QCheckBox()
+            self.hdr_tiled.setChecked(True)
+            self.hdr_tiled.stateChanged.connect(self.pic_update)
+            self.hdr_memory = QSpinBox()
+            self.hdr_memory.setRange(64, 4096)
+            self.hdr_memory.setSingleStep(64)
+            self.hdr_memory.setValue(512)
+            self.hdr_recalibrate = QPushButton("Recalibrate HDR Response")
+            self.hdr_recalibrate.clicked.connect(self.clear_response)
         self.apply_button = QPushButton("Apply")
         self.apply_button.clicked.connect(self.apply_settings)
         self.apply_button.setEnabled(False)
@@ -877,6 +1270,13 @@ class picTab(QWidget):
         res_layout.addWidget(QLabel("x"), alignment=Qt.AlignHCenter)
         res_layout.addWidget(self.resolution_h)
         resolution.setLayout(res_layout)
+        if cv_present:
+            hdr_methods = QWidget()
+            methods_layout = QHBoxLayout()
+            methods_layout.setContentsMargins(0, 0, 0, 0)
+            for check in self.hdr_method_checks.values():
+                methods_layout.addWidget(check)
+            hdr_methods.setLayout(methods_layout)
 
         self.pic_update()
         self.update_options()
@@ -887,9 +1287,15 @@ class picTab(QWidget):
         self.layout.addRow("File Type", self.filetype)
         self.layout.addRow("Resolution", resolution)
         self.layout.addRow("Sensor Mode", self.raw_format)
+        self.layout.addRow("Also Save Lores", self.save_lores)
+        self.layout.addRow("Also Save Raw (DNG)", self.save_raw)
+        self.layout.addRow(self.writer_stats)
         self.layout.addRow("Enable Preview Mode", self.preview_check)
+        self.layout.addRow(self.switch_label)
         self.layout.addRow(self.preview_warning)
         self.layout.addRow("Preview Mode", self.preview_format)
+        self.layout.addRow("Zero Shutter Lag", self.zsl_check)
+        self.layout.addRow("ZSL Frames Kept", self.zsl_size)
         # --- Autofocus widgets in the layout ---
         self.layout.addRow("Autofocus Mode", self.af_mode)
         # self.layout.addRow(self.af_trigger)
@@ -901,6 +1307,12 @@ class picTab(QWidget):
             self.layout.addRow("Number of HDR stops above", self.stops_hdr_above)
             self.layout.addRow("Number of HDR stops below", self.stops_hdr_below)
             self.layout.addRow("HDR Gamma Setting", self.hdr_gamma)
+            self.layout.addRow("HDR Outputs", hdr_methods)
+            self.layout.addRow("Tiled HDR Merge", self.hdr_tiled)
+            self.layout.addRow("HDR Memory Limit/MB", self.hdr_memory)
+            self.layout.addRow(self.hdr_recalibrate)
+            self.layout.addRow("Last HDR Times", self.hdr_times)
+            self.layout.addRow("Last HDR Bracket", self.bracket_stats)
         else:
             self.layout.addRow(QLabel("HDR unavailable - install opencv to try it out"))
 
@@ -920,6 +1332,57 @@ class picTab(QWidget):
             configs.append({"size": mode["size"], "format": mode["format"].format})
         return configs[self.preview_format.currentIndex()]
 
+    @property
+    def use_preview(self):
+        # ZSL keeps the camera in the still configuration, so never switches to preview
+        return self.preview_check.isChecked() and not self.zsl_check.isChecked()
+
+    @property
+    def still_kwargs(self):
+        if self.zsl_check.isChecked():
+            return dict(still_kwargs, buffer_count=zsl_ring.buffer_count)
+        return still_kwargs
+
+    @property
+    def outputs(self):
+        # Which streams of a capture to save, and where
+        name = self.filename.text() if self.filename.text() else 'test'
+        filetype = self.filetype.currentText()
+        if filetype == "raw":
+            outputs = {"raw": f"{name}.dng"}
+            filetype = "jpg"
+        else:
+            outputs = {"main": f"{name}.{filetype}"}
+        if self.save_lores.isChecked() and picam2.camera_config["lores"] is not None:
+            outputs["lores"] = f"{name}_lores.{filetype}"
+        if self.save_raw.isChecked() and picam2.camera_config["raw"] is not None:
+            outputs["raw"] = f"{name}.dng"
+        return outputs
+
+    def update_writer_stats(self, filename, latency):
+        self.writer_stats.setText(
+            f"Wrote {filename} in {latency:.2f}s, {image_writer.stats['pending']} still queued"
+        )
+
+    @property
+    def hdr_methods(self):
+        return [k for k, v in self.hdr_method_checks.items() if v.isChecked()]
+
+    @property
+    def hdr_max_memory(self):
+        # Working memory each merge may use in bytes, or None to merge whole frames
+        if not self.hdr_tiled.isChecked():
+            return None
+        return self.hdr_memory.value() * 2**20
+
+    def response_key(self, gain):
+        # Response curves are cached per camera, sensor mode and gain
+        return response_key(picam2.camera_properties["Model"], self.sensor_mode, gain)
+
+    def clear_response(self):
+        clear_responses(self.response_key(aec_tab.analogue_gain.value()))
+        print("Cleared HDR response for", self.response_key(aec_tab.analogue_gain.value()))
+
     @property
     def pic_dict(self):
         return {
@@ -932,8 +1395,12 @@ class picTab(QWidget):
             self.stops_hdr_below.setEnabled(self.hdr.isChecked())
             self.num_hdr.setEnabled(self.hdr.isChecked())
             self.hdr_gamma.setEnabled(self.hdr.isChecked())
+            for check in self.hdr_method_checks.values():
+                check.setEnabled(self.hdr.isChecked())
+            self.hdr_tiled.setEnabled(self.hdr.isChecked())
+            self.hdr_memory.setEnabled(self.hdr.isChecked() and self.hdr_tiled.isChecked())
         if self.isVisible():
-            picam2.set_controls(self.pic_dict)
+            control_writer.set(self.pic_dict)
         else:
             print("Not setting pic controls when not visible")
 
@@ -944,7 +1411,7 @@ class picTab(QWidget):
             self.hdr_gamma.setValue(2.2)
         picam2.still_configuration = picam2.create_still_configuration(
             main={"size": (self.resolution_w.value(), self.resolution_h.value())},
-            **still_kwargs,
+            **self.still_kwargs,
             raw=self.sensor_mode,
         )
 
@@ -978,27 +1445,56 @@ class picTab(QWidget):
         except IndexError:
             self.preview_format.setCurrentIndex(0)
 
+    @property
+    def preset(self):
+        return {
+            "filetype": self.filetype.currentText(),
+            "raw_format": self.raw_format.currentText(),
+            "size": [self.resolution_w.value(), self.resolution_h.value()],
+            "preview": self.preview_check.isChecked(),
+            "preview_format": self.preview_format.currentText(),
+        }
+
+    def apply_preset(self, preset):
+        set_combo(self.filetype, preset.get("filetype"))
+        # The sensor mode resets the resolution and preview modes, so goes first
+        set_combo(self.raw_format, preset.get("raw_format"))
+        if "size" in preset:
+            self.resolution_w.setValue(preset["size"][0])
+            self.resolution_h.setValue(preset["size"][1])
+        if "preview" in preset:
+            self.preview_check.setChecked(preset["preview"])
+        set_combo(self.preview_format, preset.get("preview_format"))
+
     def apply_settings(self):
         hide_button.setEnabled(self.preview_check.isChecked())
+        zsl_ring.stop()
+        zsl_ring.size = self.zsl_size.value()
+        zsl_ring.enabled = self.zsl_check.isChecked()
 
         # Set configurations
         picam2.still_configuration = picam2.create_still_configuration(
             main={"size": (self.resolution_w.value(), self.resolution_h.value())},
-            **still_kwargs,
+            **self.still_kwargs,
             raw=self.sensor_mode,
         )
+        preview_size = (
+            qpicamera2.width(), int(qpicamera2.width() * (self.resolution_h.value() / self.resolution_w.value()))
+        )
         picam2.preview_configuration = picam2.create_preview_configuration(
-            main={"size": (
-                qpicamera2.width(), int(qpicamera2.width() * (self.resolution_h.value() / self.resolution_w.value()))
-            )},
+            main={"size": preview_size},
+            lores={"size": lores_size_for(preview_size)},
             raw=self.preview_mode
         )
-        self.preview_format.setEnabled(self.preview_check.isChecked())
-
-        # Finally set the modes and check sensor crop
-        if self.preview_check.isChecked():
-            switch_config("still")
-            _, current_crop, _ = picam2.camera_controls['ScalerCrop']
+        self.preview_format.setEnabled(self.use_preview)
+
+        # Finally set the modes and check sensor crop. The still crop is remembered from when
+        # this configuration last ran, so it only needs switching to if it's new.
+        if self.use_preview:
+            current_crop = config_crops.get(config_snapshot("still"))
+            if current_crop is None:
+                switch_config("still")
+                current_crop = config_crops[config_snapshot("still")]
             switch_config("preview")
             _, preview_crop, _ = picam2.camera_controls['ScalerCrop']
             if current_crop != preview_crop:
@@ -1014,7 +1510,7 @@ class picTab(QWidget):
     # Autofocus Methods
     def set_af_mode(self):
         mode = self.af_mode.currentIndex()    # 0=Manual, 1=Auto, 2=Continuous
-        picam2.set_controls({"AfMode": mode})
+        control_writer.set({"AfMode": mode})
         self.af_status.setText(f"AF Mode set to {self.af_mode.currentText()}")
 
     # def trigger_af(self):
@@ -1025,6 +1521,330 @@ class picTab(QWidget):
     #         self.af_status.setText("Switch to Auto or Continuous to trigger AF")
 
 
+class motionTab(QWidget):
+    # Emitted from the detector's thread, so triggering happens on the GUI thread
+    motion = pyqtSignal(float, object)
+
+    def __init__(self):
+        super().__init__()
+        self.layout = QFormLayout()
+        self.setLayout(self.layout)
+
+        self.enable = QCheckBox()
+        self.enable.stateChanged.connect(self.motion_update)
+        self.threshold = QDoubleSpinBox()
+        self.threshold.setRange(1.0, 255.0)
+        self.threshold.valueChanged.connect(self.motion_update)
+        self.min_area = QDoubleSpinBox()
+        self.min_area.setRange(0.01, 100.0)
+        self.min_area.setSingleStep(0.1)
+        self.min_area.valueChanged.connect(self.motion_update)
+        self.roi = [QSpinBox() for _ in range(4)]
+        for box in self.roi:
+            box.setRange(0, 100)
+            box.valueChanged.connect(self.motion_update)
+        self.cooldown = QDoubleSpinBox()
+        self.cooldown.setRange(0.0, 600.0)
+        self.cooldown.valueChanged.connect(self.motion_update)
+        self.stop_after = QSpinBox()
+        self.stop_after.setRange(1, 3600)
+        self.score = QLabel("")
+        self.last_motion = 0.0
+        self.started_recording = False
+        self.motion.connect(self.on_motion)
+        # Stops recordings motion started once the scene has been still for long enough
+        self.stop_timer = QTimer()
+        self.stop_timer.timeout.connect(self.check_stop)
+        self.stop_timer.start(1000)
+        motion_detector.on_motion = self.motion.emit
+
+        # Cosmetic additions
+        roi = QWidget()
+        roi_layout = QHBoxLayout()
+        roi_layout.setContentsMargins(0, 0, 0, 0)
+        for box in self.roi:
+            roi_layout.addWidget(box)
+        roi.setLayout(roi_layout)
+
+        self.reset()
+
+        self.layout.addRow(QLabel(
+            "Takes a photo, or starts a recording in video mode, when something moves in the lores stream",
+            wordWrap=True))
+        self.layout.addRow("Motion Trigger", self.enable)
+        self.layout.addRow("Threshold", self.threshold)
+        self.layout.addRow("Min Area/%", self.min_area)
+        self.layout.addRow("Region x, y, w, h/%", roi)
+        self.layout.addRow("Cooldown/s", self.cooldown)
+        self.layout.addRow("Stop Recording After Still/s", self.stop_after)
+        self.layout.addRow(self.score)
+
+    def reset(self):
+        self.enable.setChecked(False)
+        self.threshold.setValue(12.0)
+        self.min_area.setValue(0.2)
+        for box, value in zip(self.roi, [0, 0, 100, 100]):
+            box.setValue(value)
+        self.cooldown.setValue(2.0)
+        self.stop_after.setValue(10)
+
+    def motion_update(self):
+        motion_detector.threshold = self.threshold.value()
+        motion_detector.min_area = self.min_area.value() / 100
+        x, y, w, h = [box.value() / 100 for box in self.roi]
+        motion_detector.roi = None if (x, y, w, h) == (0, 0, 1, 1) else (x, y, w, h)
+        motion_detector.cooldown = self.cooldown.value()
+        if self.enable.isChecked() and not motion_detector.enabled:
+            motion_detector.reset()
+        motion_detector.enabled = self.enable.isChecked()
+
+    def on_motion(self, score, timestamp):
+        self.score.setText(f"Motion {score * 100:.1f}% at {timestamp / 1e9:.1f}s")
+        self.last_motion = time.monotonic()
+        mark_event("motion", timestamp)
+        if trigger_event("motion"):
+            return
+        if mode_tabs.currentIndex():
+            if not recording:
+                self.started_recording = True
+                on_vid_button_clicked()
+        elif rec_button.isEnabled():
+            on_pic_button_clicked()
+
+    def check_stop(self):
+        if self.started_recording and recording and time.monotonic() - self.last_motion > self.stop_after.value():
+            print("Scene still, stopping recording")
+            on_vid_button_clicked()
+        if not recording:
+            self.started_recording = False
+
+
+class detectorTab(QWidget):
+    # Emitted from the detector's thread with each frame's boxes
+    detections = pyqtSignal(object, object)
+
+    def __init__(self):
+        super().__init__()
+        self.layout = QFormLayout()
+        self.setLayout(self.layout)
+
+        self.enable = QCheckBox()
+        self.enable.stateChanged.connect(self.detector_update)
+        self.backend = QComboBox()
+        self.backend.addItems(["Stub", "ONNX"])
+        self.model_path = QLineEdit()
+        self.batch_size = QSpinBox()
+        self.batch_size.setRange(1, 16)
+        self.batch_size.setValue(detector_stage.batch_size)
+        self.batch_size.valueChanged.connect(self.detector_update)
+        self.apply_button = QPushButton("Load Model")
+        self.apply_button.clicked.connect(self.load_backend)
+        self.trigger_events = QCheckBox()
+        self.last_boxes = QLabel("")
+        self.had_boxes = False
+        self.stats = QLabel("")
+        self.detections.connect(self.on_detections)
+        detector_stage.on_detections = self.detections.emit
+        self.stats_timer = QTimer()
+        self.stats_timer.timeout.connect(self.update_stats)
+        self.stats_timer.start(1000)
+
+        self.layout.addRow("Snail Detector", self.enable)
+        self.layout.addRow("Backend", self.backend)
+        self.layout.addRow("ONNX Model", self.model_path)
+        if not onnx_present:
+            self.layout.addRow(QLabel("ONNX unavailable - install onnxruntime to run a model"))
+        self.layout.addRow("Batch Size", self.batch_size)
+        self.layout.addRow("Detections Trigger Events", self.trigger_events)
+        self.layout.addRow(self.apply_button)
+        self.layout.addRow(self.last_boxes)
+        self.layout.addRow(self.stats)
+
+    def load_backend(self):
+        try:
+            if self.backend.currentText() == "ONNX":
+                detector_stage.backend = onnxBackend(self.model_path.text())
+            else:
+                detector_stage.backend = stubBackend()
+        except Exception as e:
+            print("Could not load detector:", e)
+            return
+        detector_stage.reset_stats()
+
+    def detector_update(self):
+        detector_stage.batch_size = self.batch_size.value()
+        if self.enable.isChecked() and not detector_stage.enabled:
+            detector_stage.reset_stats()
+        detector_stage.enabled = self.enable.isChecked()
+
+    def on_detections(self, timestamp, boxes):
+        self.last_boxes.setText(f"{len(boxes)} snails at {timestamp / 1e9:.2f}s")
+        if len(boxes) and not self.had_boxes:
+            # Only where snails first appear, rather than every frame they are seen
+            mark_event("detector", timestamp)
+        self.had_boxes = bool(len(boxes))
+        if len(boxes) and frame_rate_control is not None:
+            frame_rate_control.activity("detector")
+        if len(boxes) and self.trigger_events.isChecked():
+            trigger_event("detector")
+
+    def update_stats(self):
+        if not detector_stage.enabled:
+            return
+        stats = detector_stage.stats
+        latency = f"{stats['latency'] * 1000:.0f}ms" if stats["latency"] is not None else "-"
+        self.stats.setText(
+            f"{stats['throughput']:.1f} frames/s, latency {latency}, looking at 1 in {stats['skip'] + 1}\n"
+            f"{stats['processed']} processed, {stats['skipped']} skipped, {stats['dropped']} dropped"
+        )
+
+
+class timingTab(QWidget):
+    def __init__(self):
+        super().__init__()
+        self.layout = QFormLayout()
+        self.setLayout(self.layout)
+
+        self.summary = QLabel("")
+        self.histogram = QLabel("")
+        self.histogram.setStyleSheet("font-family: monospace")
+        self.reset_button = QPushButton("Reset")
+        self.reset_button.clicked.connect(frame_stats.reset)
+        self.timer = QTimer()
+        self.timer.timeout.connect(self.timing_update)
+        self.timer.start(1000)
+
+        self.layout.addRow(self.summary)
+        self.layout.addRow(self.histogram)
+        self.layout.addRow(self.reset_button)
+
+    def timing_update(self):
+        if not self.isVisible():
+            return
+        stats = frame_stats.stats
+        lines = [f"{stats['frames']} frames, {stats['gaps']} gaps, ~{stats['dropped']} dropped"]
+        if stats["interval_ms"]:
+            interval = stats["interval_ms"]
+            lines.append(
+                f"Frame interval {interval['mean']:.2f}ms, jitter {interval['std']:.2f}ms, "
+                f"max {interval['max']:.1f}ms"
+            )
+        writes = control_writer.stats
+        lines.append(
+            f"Controls: {writes['writes']} writes for {writes['calls']} changes, {writes['writes_avoided']} avoided, "
+            f"{writes['unchanged']} unchanged values dropped"
+        )
+        for name, times in stats["callbacks_ms"].items():
+            if times:
+                lines.append(f"{name} {times['mean']:.2f}ms mean, {times['p99']:.2f}ms p99, {times['max']:.1f}ms max")
+        self.summary.setText("\n".join(lines))
+
+        histogram = frame_stats.histogram()
+        if histogram is None:
+            return
+        counts, edges = histogram
+        scale = 30 / max(counts.max(), 1)
+        self.histogram.setText("Frame interval/ms\n" + "\n".join(
+            f"{edges[i]:7.2f} {'#' * int(c * scale)} {c}" for i, c in enumerate(counts)
+        ))
+
+
+class lazyTab(QWidget):
+    # Stands in for a tab until it is first shown, and only then builds it with make()
+    def __init__(self, make):
+        super().__init__()
+        self.make = make
+        self.widget = None
+        self.layout = QVBoxLayout()
+        self.layout.setContentsMargins(0, 0, 0, 0)
+        self.setLayout(self.layout)
+
+    def build(self):
+        if self.widget is None:
+            start = time.perf_counter()
+            self.widget = self.make()
+            self.layout.addWidget(self.widget)
+            print(f"Built {type(self.widget).__name__} in {(time.perf_counter() - start) * 1000:.0f}ms")
+        return self.widget
+
+    def showEvent(self, event):
+        self.build()
+        super().showEvent(event)
+
+
+class presetTab(QWidget):
+    # Emitted from the camera thread once a preset has taken effect
+    converged = pyqtSignal(int, float, bool)
+
+    def __init__(self):
+        super().__init__()
+        self.layout = QFormLayout()
+        self.setLayout(self.layout)
+
+        self.presets = QComboBox()
+        self.name = QLineEdit()
+        self.save_button = QPushButton("Save Current Settings")
+        self.save_button.clicked.connect(self.save)
+        self.apply_button = QPushButton("Apply")
+        self.apply_button.clicked.connect(self.apply)
+        self.delete_button = QPushButton("Delete")
+        self.delete_button.clicked.connect(self.delete)
+        self.status = QLabel("")
+        self.converged.connect(self.on_converged)
+        self.applied = 0.0
+        self.refresh()
+
+        self.layout.addRow("Preset", self.presets)
+        self.layout.addRow(self.apply_button)
+        self.layout.addRow(self.delete_button)
+        self.layout.addRow("Name", self.name)
+        self.layout.addRow(self.save_button)
+        self.layout.addRow(self.status)
+
+    def refresh(self):
+        self.presets.clear()
+        self.presets.addItems(list_presets())
+
+    def save(self):
+        name = self.name.text() if self.name.text() else self.presets.currentText()
+        if not name:
+            return
+        save_preset(name, current_preset())
+        self.refresh()
+        set_combo(self.presets, name)
+        self.status.setText(f"Saved {name}")
+
+    def apply(self):
+        name = self.presets.currentText()
+        if not name:
+            return
+        self.applied = apply_preset(load_preset(name), done=self.converged.emit)
+        self.status.setText(f"Applied {name} in {self.applied * 1000:.0f}ms, waiting for it to take effect")
+
+    def delete(self):
+        delete_preset(self.presets.currentText())
+        self.refresh()
+
+    def on_converged(self, frames, seconds, converged):
+        self.status.setText(
+            f"Applied in {self.applied * 1000:.0f}ms, "
+            + (f"took effect after {frames} frames ({seconds:.2f}s)" if converged
+               else f"still not taken effect after {frames} frames")
+        )
+
+
+def report_startup():
+    # Once the first frame's metadata reaches the GUI
+    global startup_pending
+    startup_pending = False
+    startup.mark("first frame")
+    deferred = sum(1 for tab in lazy_tabs if tab.widget is None)
+    print(
+        "Startup:", startup.report(), "(sensor modes cached)" if modes_cached else "(sensor modes enumerated)",
+        f"- {deferred} tabs not built yet"
+    )
+
+
 def toggle_hidden_controls():
     tabs.setHidden(not tabs.isHidden())
     new_width = window.width() + (-tabs.width() if tabs.isHidden() else tabs.width())
@@ -1032,54 +1852,32 @@ def toggle_hidden_controls():
     hide_button.setText("<" if tabs.isHidden() else ">")
 
 
-implemented_controls = [
-    "ColourCorrectionMatrix",
-    "Saturation",
-    "Contrast",
-    "Sharpness",
-    "Brightness",
-    "NoiseReductionMode",
-    "AeEnable",
-    "AeMeteringMode",
-    "AeConstraintMode",
-    "AeExposureMode",
-    "AwbEnable",
-    "AwbMode",
-    "ExposureValue",
-    "ExposureTime",
-    "AnalogueGain",
-    "ColourGains",
-    "ScalerCrop",
-    "FrameDurationLimits"
-]
-
-ignore_controls = {
-    # It is not helpful to try to drive AF with simple slider controls, so ignore them.
-    # "AfMode",
-    # "AfTrigger",
-    "AfSpeed",
-    "AfRange",
-    "AfWindows",
-    "AfPause",
-    "AfMetering",
-    "ScalerCrops"
-}
-
 # Main widgets
 window = QWidget()
 bg_colour = window.palette().color(QPalette.Background).getRgb()[:3]
 qpicamera2 = QGlPicamera2(picam2, width=800, height=600, keep_ar=True, bg_colour=bg_colour)
 rec_button = QPushButton("Take Photo")
 rec_button.clicked.connect(on_rec_button_clicked)
+# Outside the mode tabs, which are disabled while recording
+event_button = QPushButton("Save Event")
+event_button.setEnabled(False)
+event_button.clicked.connect(lambda: trigger_event("button"))
 qpicamera2.done_signal.connect(capture_done)
 
 # Tabs
 tabs = QTabWidget()
-img_tab = IMGTab()
+# Tabs nothing else needs straight away are only built when first opened
+img_tab = lazyTab(IMGTab)
 pan_tab = panTab()
 aec_tab = AECTab()
-info_tab = QLabel(alignment=Qt.AlignTop)
-other_tab = otherTab()
+info_tab = lazyTab(lambda: infoTab(metadata_feed, metadata_recorder))
+metadata_feed.updated.connect(show_metadata)
+other_tab = lazyTab(otherTab)
+motion_tab = lazyTab(motionTab)
+detector_tab = lazyTab(detectorTab)
+timing_tab = lazyTab(timingTab)
+preset_tab = lazyTab(presetTab)
+lazy_tabs = [img_tab, info_tab, other_tab, motion_tab, detector_tab, timing_tab, preset_tab]
 hide_button = QPushButton(">")
 hide_button.clicked.connect(toggle_hidden_controls)
 hide_button.setMaximumSize(50, 400)
@@ -1089,12 +1887,15 @@ mode_tabs = QTabWidget()
 pic_tab = picTab()
 vid_tab = vidTab()
 mode_tabs.currentChanged.connect(on_mode_change)
+pic_tab.bracket_done.connect(on_bracket_done)
+pic_tab.hdr_done.connect(hdr_done)
 
 # Final setup
 window.setWindowTitle("Qt Picamera2 App")
 recording = False
-_, scaler_crop, _ = picam2.camera_controls['ScalerCrop']
 hdr_imgs = {"exposures": None}
+hdr_bracket = None
+startup_pending = True
 pic_tab.apply_settings()
 
 tabs.setFixedWidth(400)
@@ -1107,12 +1908,17 @@ tabs.addTab(pan_tab, "Pan/Zoom")
 tabs.addTab(aec_tab, "AEC/AWB")
 tabs.addTab(info_tab, "Info")
 tabs.addTab(other_tab, "Other")
+tabs.addTab(motion_tab, "Motion")
+tabs.addTab(detector_tab, "Detector")
+tabs.addTab(timing_tab, "Timing")
+tabs.addTab(preset_tab, "Presets")
 
 mode_tabs.addTab(pic_tab, "Still Capture")
 mode_tabs.addTab(vid_tab, "Video")
 
 layout_v.addWidget(mode_tabs)
 layout_v.addWidget(rec_button)
+layout_v.addWidget(event_button)
 
 layout_h.addLayout(layout_v)
 layout_h.addWidget(qpicamera2)
@@ -1121,7 +1927,13 @@ layout_h.addWidget(tabs)
 
 window.resize(1600, 600)
 window.setLayout(layout_h)
+startup.mark("widgets")
 
 if __name__ == "__main__":
     window.show()
+    startup.mark("window shown")
     app.exec()
+    metadata_recorder.stop()
+    metadata_recorder.flush_queue.join()
+    image_writer.shutdown()
+    hdr_engine.shutdown()
@@ -0,0 +1,268 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from fake_camera import default_sensor_modes, fakePicamera2
+from frame_stats import frameStats
+from hdr import merge, merge_methods, merge_tiled
+from metadata_format import format_row, sort_key
+from motion import lores_size_for, lores_y, motionDetector
+from recorder import metadataRecorder
+
+try:
+    import cv2
+    cv_present = True
+except ImportError:
+    cv_present = False
+
+still_filetypes = ["jpg", "png", "bmp", "gif", "dng"]
+
+
+def timeit(function, runs, warmup=1):
+    # Seconds per call of function(), over runs calls after warming up
+    for _ in range(warmup):
+        function()
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {"mean_s": float(np.mean(times)), "min_s": float(np.min(times)), "runs": runs}
+
+
+def make_camera(kind):
+    if kind == "real":
+        from picamera2 import Picamera2
+        return Picamera2()
+    return fakePicamera2(realtime=False)
+
+
+def synthetic_bracket(camera, size, number=3):
+    # An HDR bracket of BGR frames from the fake camera, one to two stops apart
+    camera.still_configuration = camera.create_still_configuration(main={"size": size})
+    camera.configure("still")
+    exposures = [int(10000 * 2 ** (i - number // 2)) for i in range(number)]
+    frames = []
+    for exposure in exposures:
+        metadata = camera.frame_metadata()
+        metadata.update(ExposureTime=exposure, AnalogueGain=1.0)
+        request = camera.next_request()
+        request.metadata = metadata
+        frames.append(request.make_array("main"))
+    return np.stack(frames), np.array(exposures, dtype=np.float32) / 1e6
+
+
+def bench_hdr(results, args, directory):
+    if not cv_present:
+        print("OpenCV not found - skipping HDR")
+        return
+    camera = fakePicamera2(realtime=False)
+    for size, _, _ in default_sensor_modes:
+        if args.max_pixels and size[0] * size[1] > args.max_pixels:
+            continue
+        stack, exposures = synthetic_bracket(camera, size, args.hdr_frames)
+        for method in merge_methods:
+            name = f"hdr/{method}/{size[0]}x{size[1]}"
+            results[name] = timeit(lambda: merge(method, stack, exposures, 2.2), args.runs)
+            print(name, f"{results[name]['mean_s']:.3f}s")
+            if args.tiled:
+                filename = os.path.join(directory, f"tiled_{method}.jpg")
+                name = f"hdr_tiled/{method}/{size[0]}x{size[1]}"
+                results[name] = timeit(
+                    lambda: merge_tiled(method, stack, exposures, 2.2, filename, args.tiled * 2**20), args.runs
+                )
+                print(name, f"{results[name]['mean_s']:.3f}s")
+
+
+def bench_save(results, args, directory, camera):
+    sizes = [size for size, _, _ in default_sensor_modes
+             if not args.max_pixels or size[0] * size[1] <= args.max_pixels]
+    for size in sizes:
+        camera.still_configuration = camera.create_still_configuration(main={"size": size})
+        camera.configure("still")
+        camera.start()
+        request = camera.capture_request()
+        try:
+            metadata = request.get_metadata()
+            buffers = {s: request.make_buffer(s) for s in ("main", "raw")}
+            configs = {s: request.config[s] for s in ("main", "raw")}
+        finally:
+            request.release()
+        camera.stop()
+        helpers = camera.helpers
+        for filetype in still_filetypes:
+            if filetype == "dng" and args.camera != "real":
+                # The fake's save_dng only dumps the raw buffer, so timing it says nothing
+                print("save/dng needs --camera real, skipping")
+                continue
+            filename = os.path.join(directory, f"still.{filetype}")
+            if filetype == "dng":
+                def save():
+                    helpers.save_dng(buffers["raw"], metadata, configs["raw"], filename)
+            else:
+                def save():
+                    helpers.save(helpers.make_image(buffers["main"], configs["main"]), metadata, filename)
+            name = f"save/{filetype}/{size[0]}x{size[1]}"
+            try:
+                results[name] = timeit(save, args.runs)
+            except Exception as e:
+                print(name, "failed:", e)
+                continue
+            print(name, f"{results[name]['mean_s']:.3f}s")
+
+
+def bench_metadata(results, args, directory):
+    camera = fakePicamera2(realtime=False)
+    size = (1280, 720)
+    camera.video_configuration = camera.create_video_configuration(
+        main={"size": size}, lores={"size": lores_size_for(size)}
+    )
+    camera.configure("video")
+    request = camera.next_request()
+    metadata = request.get_metadata()
+    metadata["ColourCorrectionMatrix"] = tuple(float(x) for x in np.eye(3).ravel())
+    frames = 1000
+
+    def format_all():
+        for _ in range(frames):
+            "\n".join(format_row(k, v) for k, v in sorted(metadata.items(), key=lambda x: sort_key(x[0])))
+
+
+    stats = frameStats()
+
+    def frame_stats():
+        for _ in range(frames):
+            stats.frame(metadata)
+
+    recorder = metadataRecorder(directory=directory, chunk_frames=4096)
+    recorder.start("bench")
+
+    def record():
+        for _ in range(frames):
+            recorder.append(metadata)
+
+    # The camera thread's share of motion detection is the lores copy, the rest is the worker's
+    detector = motionDetector()
+    y = lores_y(request)
+
+    def motion_copy():
+        for _ in range(frames):
+            lores_y(request)
+
+    def motion_process():
+        for _ in range(frames):
+            detector.process(y, 0)
+
+    results["metadata/format_all_rows"] = per_frame(timeit(format_all, args.runs), frames)
+    results["metadata/frame_stats"] = per_frame(timeit(frame_stats, args.runs), frames)
+    results["metadata/recorder_append"] = per_frame(timeit(record, args.runs), frames)
+    results["motion/lores_copy"] = per_frame(timeit(motion_copy, args.runs), frames)
+    results["motion/process"] = per_frame(timeit(motion_process, args.runs), frames)
+    recorder.stop()
+    recorder.flush_queue.join()
+    for name in [k for k in results if k.startswith(("metadata/", "motion/"))]:
+        print(name, f"{results[name]['mean_s'] * 1e6:.1f}us per frame")
+
+
+def per_frame(result, frames):
+    return {k: v / frames if k.endswith("_s") else v for k, v in result.items()}
+
+
+def bench_switch(results, args, camera):
+    if args.camera != "real":
+        # The fake's configure only swaps dictionaries, so there would be nothing to time
+        print("config/switch needs --camera real, skipping")
+        return
+    camera.still_configuration = camera.create_still_configuration()
+    camera.preview_configuration = camera.create_preview_configuration()
+    state = {"config": "still"}
+
+    def switch():
+        state["config"] = "preview" if state["config"] == "still" else "still"
+        camera.stop()
+        camera.configure(state["config"])
+        camera.start()
+
+    camera.configure("still")
+    camera.start()
+    results["config/switch"] = timeit(switch, args.runs)
+    camera.stop()
+    print("config/switch", f"{results['config/switch']['mean_s'] * 1000:.1f}ms")
+
+
+def compare(results, baseline_path, tolerance):
+    # Print how each benchmark moved against a previous run, returning the regressions
+    with open(baseline_path) as f:
+        baseline = json.load(f)["results"]
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        ratio = result["mean_s"] / baseline[name]["mean_s"] if baseline[name]["mean_s"] else 1.0
+        flag = ""
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+            flag = " REGRESSION"
+        print(f"{name}: {ratio:.2f}x{flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the capture, HDR and metadata hot paths")
+    parser.add_argument("--output", default="benchmark.json", help="Where to write the results as JSON")
+    parser.add_argument("--compare", help="Previous results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Slowdown that counts as a regression")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--camera", choices=["fake", "real"], default="fake",
+                        help="Camera for the save and config switch benchmarks")
+    parser.add_argument("--only", nargs="+", choices=["hdr", "save", "metadata", "switch"],
+                        default=["hdr", "save", "metadata", "switch"])
+    parser.add_argument("--hdr-frames", type=int, default=3)
+    parser.add_argument("--tiled", type=int, default=0, help="Also time tiled merges with this many MB")
+    parser.add_argument("--max-pixels", type=int, default=0, help="Skip sensor modes bigger than this")
+    args = parser.parse_args()
+
+    results = {}
+    camera = make_camera(args.camera) if {"save", "switch"} & set(args.only) else None
+    # Without the real camera, save/dng and config/switch are skipped rather than recorded
+    # from the fake, so a baseline never holds numbers that don't measure the app
+    with tempfile.TemporaryDirectory() as directory:
+        if "hdr" in args.only:
+            bench_hdr(results, args, directory)
+        if "save" in args.only:
+            bench_save(results, args, directory, camera)
+        if "metadata" in args.only:
+            bench_metadata(results, args, directory)
+        if "switch" in args.only:
+            bench_switch(results, args, camera)
+
+    report = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host": platform.node(),
+            "machine": platform.machine(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__ if cv_present else None,
+            "camera": args.camera,
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Saved results to", args.output)
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        if regressions:
+            print(len(regressions), "regressions")
+            sys.exit(1)
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+import threading
+import time
+
+import numpy as np
+
+
+def bracket_exposures(exposure, below, above, number, min_exposure, max_exposure):
+    # Exposure times (us) for a bracket from below to above stops around exposure, sorted
+    e_log = np.log2(exposure)
+    max_e = np.log2(max_exposure)
+    if e_log + 1 > max_e:
+        above = max_e - e_log
+        print("Desired exposure too long, reducing", e_log + 1, max_e, above)
+    # list(set()) to ensure uniqueness
+    exposures = list(set(np.logspace(e_log - below, e_log + above, number, base=2.0, dtype=int)))
+    # Remove any 0 exposures
+    if 0 in exposures:
+        exposures[exposures.index(0)] = min_exposure
+    exposures.sort()
+    return exposures
+
+
+class bracketScheduler:
+    # Collects one frame for each exposure time of an HDR bracket. Rather than setting an
+    # exposure and waiting for it to land before asking for the next, the exposure for each
+    # upcoming request is queued as soon as a frame comes back, so the camera's control
+    # pipeline always has the next few exposures in flight. Frames are identified purely by
+    # the ExposureTime/SensorTimestamp they report, and anything that isn't wanted is wasted.
+    def __init__(self, picam2, exposures, store, done=None, tolerance=0.1, settle_frames=6, max_frames=None):
+        self.picam2 = picam2
+        self.exposures = list(exposures)
+        # store(index, request) copies the frame out of the request, which is released after
+        self.store = store
+        # done(scheduler) is called from the worker thread once finished
+        self.done = done
+        self.tolerance = tolerance
+        # Frames to wait before asking again for an exposure that hasn't shown up
+        self.settle_frames = settle_frames
+        self.max_frames = max_frames if max_frames else 10 * len(self.exposures) + 30
+        # (ExposureTime, SensorTimestamp) of the frame used for each exposure
+        self.taken = [None] * len(self.exposures)
+        self.queued_at = [None] * len(self.exposures)
+        self.frames = 0
+        self.wasted = 0
+        self.elapsed = 0.0
+        self.thread = None
+
+    @property
+    def complete(self):
+        return None not in self.taken
+
+    @property
+    def missing(self):
+        return [i for i, t in enumerate(self.taken) if t is None]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def match(self, exposure):
+        # Index of the wanted exposure this frame was taken at, if we still need it
+        i = min(range(len(self.exposures)), key=lambda i: abs(self.exposures[i] - exposure))
+        if self.taken[i] is None and abs(self.exposures[i] - exposure) <= self.tolerance * self.exposures[i]:
+            return i
+        return None
+
+    def queue(self, i):
+        self.picam2.set_controls({"AeEnable": False, "ExposureTime": self.exposures[i]})
+        self.queued_at[i] = self.frames
+
+    def queue_next(self):
+        # First time round, one new exposure per frame. After that only ask again for any
+        # that should have arrived by now but haven't
+        for i in self.missing:
+            if self.queued_at[i] is None or self.frames - self.queued_at[i] > self.settle_frames:
+                self.queue(i)
+                return
+
+    def run(self):
+        start = time.perf_counter()
+        last_timestamp = 0
+        self.queue_next()
+        while not self.complete and self.frames < self.max_frames:
+            request = self.picam2.capture_request()
+            try:
+                self.frames += 1
+                metadata = request.get_metadata()
+                i = self.match(metadata["ExposureTime"])
+                # Never take a frame older than one we already have
+                if i is not None and metadata["SensorTimestamp"] > last_timestamp:
+                    self.store(i, request)
+                    self.taken[i] = (metadata["ExposureTime"], metadata["SensorTimestamp"])
+                    last_timestamp = metadata["SensorTimestamp"]
+                else:
+                    self.wasted += 1
+            finally:
+                request.release()
+            self.queue_next()
+        self.elapsed = time.perf_counter() - start
+        print(
+            f"Bracket of {len(self.exposures)} took {self.frames} frames ({self.wasted} wasted) "
+            f"in {self.elapsed:.2f}s", "" if self.complete else f"- missing exposures {self.missing}"
+        )
+        if self.done is not None:
+            self.done(self)
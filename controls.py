@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+
+import threading
+from contextlib import contextmanager
+
+# Controls with their own widgets in the app, or that the daemon takes from its config
+implemented_controls = [
+    "ColourCorrectionMatrix",
+    "Saturation",
+    "Contrast",
+    "Sharpness",
+    "Brightness",
+    "NoiseReductionMode",
+    "AeEnable",
+    "AeMeteringMode",
+    "AeConstraintMode",
+    "AeExposureMode",
+    "AwbEnable",
+    "AwbMode",
+    "ExposureValue",
+    "ExposureTime",
+    "AnalogueGain",
+    "ColourGains",
+    "ScalerCrop",
+    "FrameDurationLimits"
+]
+
+ignore_controls = {
+    # It is not helpful to try to drive AF with simple slider controls, so ignore them.
+    # "AfMode",
+    # "AfTrigger",
+    "AfSpeed",
+    "AfRange",
+    "AfWindows",
+    "AfPause",
+    "AfMetering",
+    "ScalerCrops"
+}
+
+
+class controlWriter:
+    # Collects control changes from all the tabs and hands the camera one merged set_controls
+    # per frame. Values the camera was already sent are dropped, and a control changed
+    # several times between frames only goes out with its latest value.
+    def __init__(self, picam2):
+        self.picam2 = picam2
+        self.lock = threading.Lock()
+        self.pending = {}
+        # Nested hold() blocks in progress
+        self.held = 0
+        # What each control was last sent as
+        self.sent = {}
+        # set() calls, each of which used to be a set_controls of its own
+        self.calls = 0
+        # set_controls calls actually made
+        self.writes = 0
+        # Values dropped as already sent, or replaced by a newer one before going out
+        self.unchanged = 0
+        self.replaced = 0
+
+    def set(self, controls):
+        # Queue controls to go out with the next frame, from any thread
+        with self.lock:
+            self.calls += 1
+            for k, v in controls.items():
+                if isinstance(v, list):
+                    v = tuple(v)
+                if k in self.pending:
+                    self.replaced += 1
+                    del self.pending[k]
+                if k in self.sent and self.sent[k] == v:
+                    self.unchanged += 1
+                else:
+                    self.pending[k] = v
+
+    @contextmanager
+    def hold(self):
+        # Nothing goes out until the end of the with block, then it all goes together
+        with self.lock:
+            self.held += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.held -= 1
+            self.flush()
+
+    def flush(self):
+        # Called from post_callback once per frame, or directly when the controls must go
+        # out before something else happens
+        with self.lock:
+            if not self.pending or self.held:
+                return
+            controls, self.pending = self.pending, {}
+            self.sent.update(controls)
+            self.writes += 1
+        self.picam2.set_controls(controls)
+
+    def forget(self):
+        # After a configure the camera may not hold what it was last sent, so send it all again
+        with self.lock:
+            self.sent = {}
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "writes": self.writes,
+                "writes_avoided": max(self.calls - self.writes, 0),
+                "unchanged": self.unchanged,
+                "replaced": self.replaced,
+                "pending": len(self.pending),
+            }
+
+
+class cropSmoother:
+    # Eases ScalerCrop towards where the pan/zoom display last put it, moving a fraction of
+    # the way each frame. However fast the mouse events come, the camera gets at most one
+    # small crop change per frame through the control writer.
+    def __init__(self, control_writer, crop, smoothing=0.35):
+        self.control_writer = control_writer
+        # Fraction of the remaining distance covered each frame, 1 to jump straight there
+        self.smoothing = smoothing
+        self.target = tuple(crop)
+        self.current = tuple(crop)
+
+    def set_target(self, crop):
+        # From the GUI thread, as often as it likes
+        self.target = tuple(crop)
+
+    def jump(self, crop):
+        # Straight there, such as when a new configuration starts
+        self.target = self.current = tuple(crop)
+        self.control_writer.set({"ScalerCrop": self.current})
+
+    def step(self):
+        # Called from post_callback once per frame, before the control writer flushes
+        target, current = self.target, self.current
+        if target == current:
+            return
+        crop = tuple(int(round(c + self.smoothing * (t - c))) for c, t in zip(current, target))
+        # Snap the last few pixels rather than crawling towards them
+        if crop == current or max(abs(t - c) for c, t in zip(crop, target)) <= max(2, target[2] // 200):
+            crop = target
+        self.current = crop
+        self.control_writer.set({"ScalerCrop": crop})
@@ -0,0 +1,436 @@
+#!/usr/bin/python3
+
+import argparse
+import datetime
+import importlib.util
+import json
+import os
+import queue
+import signal
+import threading
+import time
+
+from bracket import bracket_exposures, bracketScheduler
+from controls import ignore_controls, implemented_controls
+from frame_stats import frameStats
+from hdr import hdrBracket, hdrEngine, merge_methods, response_key
+from motion import lores_size_for, motionDetector
+from presets import load_preset
+from recorder import metadataRecorder
+from sensor_modes import load_sensor_modes
+from writer import writerPool
+
+# OpenCV is only imported when an HDR bracket first needs it
+cv_present = importlib.util.find_spec("cv2") is not None
+if not cv_present:
+    print("OpenCV not found - HDR not available")
+
+# Everything a session config can set, and what it is when left out
+default_config = {
+    # "real" for Picamera2, or "fake" for fake_camera (replaying "replay" if given)
+    "camera": "real",
+    "replay": None,
+    # Index into picam2.sensor_modes, or None to let libcamera pick
+    "sensor_mode": None,
+    # A preset saved from the app, whose controls the ones below add to or override
+    "preset": None,
+    # Any of implemented_controls, or the camera's other controls
+    "controls": {},
+    "still": {"size": None, "filetype": "jpg", "lores": False, "raw": False},
+    "video": {"size": [1280, 720], "framerate": 30, "quality": "Medium", "filetype": "mp4"},
+    "hdr": {"below": 2, "above": 2, "number": 3, "gamma": 2.2, "methods": ["mertens"], "max_memory_mb": None},
+    "output": {"stills": "captures", "videos": "videos", "metadata": "metadata"},
+    "metadata": {"record": False, "chunk_frames": 4096},
+    # action is what to do on motion: "still", "hdr", "video" (for duration seconds) or None
+    # just to log it
+    "motion": {
+        "enabled": False, "threshold": 12.0, "min_area": 0.002, "roi": None, "cooldown": 60.0,
+        "action": "still", "duration": 30,
+    },
+    # Each is {"action": "still"|"hdr"|"video", "every": seconds or "at": ["HH:MM", ...],
+    # optionally "between": ["HH:MM", "HH:MM"] and, for video, "duration": seconds}
+    "schedules": [],
+    # Frames to let the AEC/AGC settle after the camera starts before capturing
+    "settle_frames": 10,
+    # Seconds between status lines
+    "status_interval": 600,
+}
+
+
+def load_config(path):
+    # The session config from a JSON file, on top of default_config
+    with open(path) as f:
+        config = json.load(f)
+    unknown = set(config) - set(default_config)
+    if unknown:
+        raise ValueError(f"Unknown config keys {sorted(unknown)}")
+    merged = {}
+    for k, v in default_config.items():
+        if isinstance(v, dict) and k != "controls":
+            merged[k] = dict(v, **config.get(k, {}))
+        else:
+            merged[k] = config.get(k, v)
+    for schedule in merged["schedules"]:
+        if schedule.get("action") not in ("still", "hdr", "video"):
+            raise ValueError(f"Schedule needs an action of still, hdr or video: {schedule}")
+        if "every" not in schedule and "at" not in schedule:
+            raise ValueError(f"Schedule needs either every or at: {schedule}")
+    return merged
+
+
+def check_controls(controls, camera_controls):
+    # Drop any controls the camera doesn't have or the app never sets
+    checked = {}
+    for k, v in controls.items():
+        if k not in camera_controls or k in ignore_controls:
+            print("Ignoring control", k)
+            continue
+        if k not in implemented_controls:
+            print("Setting other control", k)
+        checked[k] = tuple(v) if isinstance(v, list) else v
+    return checked
+
+
+def parse_time(text):
+    hours, minutes = text.split(":")
+    return datetime.time(int(hours), int(minutes))
+
+
+class schedule:
+    # When a scheduled action is next due, either every so many seconds or at set times
+    # of day, and only inside the between window if there is one
+    def __init__(self, entry, now=None):
+        self.entry = entry
+        self.action = entry["action"]
+        self.every = entry.get("every")
+        self.at = sorted(parse_time(t) for t in entry.get("at", []))
+        self.between = [parse_time(t) for t in entry["between"]] if "between" in entry else None
+        self.runs = 0
+        self.due = self.next_after(now if now is not None else datetime.datetime.now(), first=True)
+
+    def in_window(self, when):
+        if self.between is None:
+            return True
+        start, end = self.between
+        if start <= end:
+            return start <= when.time() < end
+        # Overnight, such as 20:00 to 06:00
+        return when.time() >= start or when.time() < end
+
+    def window_start(self, when):
+        # The next time the window opens at or after when
+        start = datetime.datetime.combine(when.date(), self.between[0])
+        return start if start >= when else start + datetime.timedelta(days=1)
+
+    def next_after(self, when, first=False):
+        if self.at:
+            for day in range(2):
+                date = when.date() + datetime.timedelta(days=day)
+                for t in self.at:
+                    due = datetime.datetime.combine(date, t)
+                    if due > when and self.in_window(due):
+                        return due
+            return None
+        due = when if first else when + datetime.timedelta(seconds=self.every)
+        if not self.in_window(due):
+            due = self.window_start(due)
+        return due
+
+    def done(self, now):
+        self.runs += 1
+        self.due = self.next_after(max(now, self.due))
+
+
+class captureDaemon:
+    # The capture side of app_full.py without any widgets. The camera is only kept running
+    # between actions when motion detection or metadata recording need its frames, and
+    # everything runs from one loop that sleeps until the next schedule or motion event.
+    def __init__(self, config):
+        self.config = config
+        self.stopping = threading.Event()
+        self.actions = queue.Queue(maxsize=8)
+        self.recording = False
+        # Set up the HDR workers before the camera starts any threads
+        self.hdr_engine = hdrEngine()
+        if cv_present:
+            self.hdr_engine.start()
+        self.picam2 = self.open_camera()
+        self.sensor_mode = self.pick_sensor_mode()
+        controls = config["controls"]
+        if config["preset"]:
+            controls = dict(load_preset(config["preset"])["controls"], **controls)
+        self.controls = check_controls(controls, self.picam2.camera_controls)
+        self.make_configurations()
+        self.active_config = None
+        self.image_writer = writerPool(self.picam2)
+        self.frame_stats = frameStats()
+        self.metadata_recorder = metadataRecorder(
+            config["output"]["metadata"], config["metadata"]["chunk_frames"]
+        )
+        motion = config["motion"]
+        self.motion_detector = motionDetector(
+            on_motion=self.on_motion, threshold=motion["threshold"], min_area=motion["min_area"],
+            roi=motion["roi"], cooldown=motion["cooldown"]
+        )
+        self.motion_detector.enabled = motion["enabled"]
+        self.picam2.post_callback = self.post_callback
+        now = datetime.datetime.now()
+        self.schedules = [schedule(entry, now) for entry in config["schedules"]]
+        for directory in (config["output"]["stills"], config["output"]["videos"]):
+            os.makedirs(directory, exist_ok=True)
+
+    def open_camera(self):
+        if self.config["camera"] == "fake":
+            from fake_camera import fakePicamera2
+            return fakePicamera2(replay=self.config["replay"])
+        from picamera2 import Picamera2
+        picam2 = Picamera2()
+        load_sensor_modes(picam2)
+        return picam2
+
+    def pick_sensor_mode(self):
+        # As vidTab.sensor_mode, {} when libcamera picks
+        if self.config["sensor_mode"] is None:
+            return {}
+        mode = self.picam2.sensor_modes[self.config["sensor_mode"]]
+        return {"size": mode["size"], "format": mode["format"].format}
+
+    @property
+    def keep_running(self):
+        # Whether anything needs frames while no action is under way
+        return self.motion_detector.enabled or self.metadata_recorder.enabled
+
+    def make_configurations(self):
+        raw = self.sensor_mode if self.sensor_mode else None
+        still, video = self.config["still"], self.config["video"]
+        still_main = {"size": tuple(still["size"])} if still["size"] else {}
+        still_size = still_main.get("size", self.picam2.sensor_resolution)
+        self.picam2.still_configuration = self.picam2.create_still_configuration(
+            main=still_main, lores={"size": lores_size_for(still_size)}, raw=raw, buffer_count=2
+        )
+        video_size = tuple(video["size"])
+        self.picam2.video_configuration = self.picam2.create_video_configuration(
+            main={"size": video_size}, lores={"size": lores_size_for(video_size)}, raw=raw
+        )
+        # Idling only feeds motion detection and metadata, so keep it small
+        self.picam2.preview_configuration = self.picam2.create_preview_configuration(
+            main={"size": (640, 480)}, lores={"size": lores_size_for((640, 480))}, raw=raw
+        )
+
+    def post_callback(self, request):
+        # Runs on the camera thread for every frame, so only hands things on
+        with self.frame_stats.timed("post_callback"):
+            metadata = request.get_metadata()
+            self.frame_stats.frame(metadata)
+            self.metadata_recorder.append(metadata)
+            self.motion_detector.submit(request)
+
+    def on_motion(self, score, timestamp):
+        # Called from the motion worker thread
+        print(f"Motion {score:.3f} at {timestamp}")
+        if self.config["motion"]["action"] is not None and not self.recording:
+            try:
+                self.actions.put_nowait(self.config["motion"]["action"])
+            except queue.Full:
+                pass
+
+    def switch_config(self, name):
+        # As app_full.switch_config, skipping a restart into the configuration already running
+        if self.active_config == name:
+            return
+        start = time.perf_counter()
+        self.picam2.stop()
+        self.picam2.configure(name)
+        self.picam2.set_controls(self.controls)
+        self.picam2.start()
+        self.active_config = name
+        print(f"Switched to {name} in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    def settle(self):
+        for _ in range(self.config["settle_frames"]):
+            self.picam2.capture_request().release()
+
+    def idle(self):
+        if self.keep_running:
+            self.switch_config("preview")
+        else:
+            self.picam2.stop()
+            self.active_config = None
+
+    def filename(self, kind, filetype):
+        directory = self.config["output"]["videos" if kind == "video" else "stills"]
+        return os.path.join(directory, f"{kind}_{time.strftime('%Y%m%d-%H%M%S')}.{filetype}")
+
+    def take_still(self):
+        self.switch_config("still")
+        self.settle()
+        still = self.config["still"]
+        name = self.filename("still", still["filetype"])
+        stem = os.path.splitext(name)[0]
+        outputs = {"main": name}
+        if still["lores"]:
+            outputs["lores"] = f"{stem}_lores.{still['filetype']}"
+        if still["raw"] and self.picam2.camera_config["raw"] is not None:
+            outputs["raw"] = f"{stem}.dng"
+        self.image_writer.write_request(self.picam2.capture_request(), outputs, done=self.written)
+
+    def written(self, filename, latency):
+        print(f"Wrote {filename} in {latency:.2f}s")
+
+    def take_hdr(self):
+        if not cv_present:
+            print("Skipping HDR, OpenCV not found")
+            return
+        import cv2
+        hdr = self.config["hdr"]
+        self.switch_config("still")
+        self.settle()
+        request = self.picam2.capture_request()
+        base = cv2.cvtColor(request.make_array("main"), cv2.COLOR_RGB2BGR)
+        metadata = request.get_metadata()
+        request.release()
+        exposures = bracket_exposures(
+            metadata["ExposureTime"], hdr["below"], hdr["above"], hdr["number"],
+            self.picam2.camera_controls["ExposureTime"][0], self.picam2.camera_controls["FrameDurationLimits"][1]
+        )
+        stem = os.path.splitext(self.filename("hdr", "jpg"))[0]
+        filetype = self.config["still"]["filetype"]
+        self.image_writer.write_array(base, f"{stem}_base.{filetype}", done=self.written)
+        bracket = hdrBracket(len(exposures), base.shape)
+
+        def store(i, request):
+            cv2.cvtColor(request.make_array("main"), cv2.COLOR_RGB2BGR, dst=bracket.stack[i])
+
+        # The AEC comes back on with the session's own controls afterwards
+        scheduler = bracketScheduler(self.picam2, exposures, store)
+        scheduler.run()
+        self.picam2.set_controls(dict(self.controls, AeEnable=self.controls.get("AeEnable", True)))
+        if not scheduler.complete:
+            print("Giving up on HDR bracket, missing exposures", [exposures[i] for i in scheduler.missing])
+            bracket.release()
+            return
+        taken = [t[0] / 1e6 for t in scheduler.taken]
+        filenames = {method: f"{stem}_{method}.{filetype}" for method in merge_methods}
+        max_memory = hdr["max_memory_mb"] * 2**20 if hdr["max_memory_mb"] else None
+        key = response_key(self.picam2.camera_properties["Model"], self.sensor_mode, metadata["AnalogueGain"])
+        self.hdr_engine.process(
+            bracket, taken, hdr["methods"], hdr["gamma"], filenames, done=self.hdr_done,
+            max_memory=max_memory, key=key
+        )
+
+    def hdr_done(self, timings):
+        print("HDR merged", ", ".join(f"{k} {v:.1f}s" for k, v in timings.items()))
+
+    def record_video(self, duration):
+        video = self.config["video"]
+        self.switch_config("video")
+        self.picam2.set_controls({"FrameRate": video["framerate"]})
+        name = self.filename("video", video["filetype"])
+        if self.config["camera"] == "fake":
+            from fake_camera import fakeEncoder, fakeFileOutput
+            encoder, output, quality = fakeEncoder(framerate=video["framerate"]), fakeFileOutput(name), None
+        else:
+            from picamera2.encoders import H264Encoder, Quality
+            from picamera2.outputs import FfmpegOutput, FileOutput
+            encoder = H264Encoder()
+            if video["filetype"] in ["mp4", "mkv", "mov", "ts", "avi"]:
+                output = FfmpegOutput(name)
+            else:
+                output = FileOutput(name)
+            quality = Quality[video["quality"].upper().replace(" ", "_")]
+        print("Recording", name, f"for {duration}s")
+        self.recording = True
+        self.picam2.start_encoder(encoder, output, quality=quality)
+        try:
+            self.stopping.wait(duration)
+        finally:
+            self.picam2.stop_encoder()
+            self.recording = False
+
+    def run_action(self, action, entry=None):
+        start = time.perf_counter()
+        try:
+            if action == "still":
+                self.take_still()
+            elif action == "hdr":
+                self.take_hdr()
+            elif action == "video":
+                self.record_video((entry or {}).get("duration", 60))
+        except Exception as e:
+            print(f"{action} failed:", e)
+        print(f"{action} took {time.perf_counter() - start:.1f}s")
+
+    def status(self):
+        stats = self.frame_stats.stats
+        writer = self.image_writer.stats
+        print(
+            f"Status: {stats['frames']} frames, {stats['dropped']} dropped, {writer['written']} files written, "
+            f"{writer['failed']} failed, {writer['pending']} pending, {self.hdr_engine.busy} HDR merges, "
+            f"{self.metadata_recorder.frames} metadata frames, motion {self.motion_detector.score:.3f}",
+            flush=True
+        )
+
+    def run(self):
+        if self.config["metadata"]["record"]:
+            self.metadata_recorder.start()
+        self.idle()
+        last_status = time.monotonic()
+        while not self.stopping.is_set():
+            now = datetime.datetime.now()
+            due = [s for s in self.schedules if s.due is not None and s.due <= now]
+            for s in due:
+                self.run_action(s.action, s.entry)
+                s.done(datetime.datetime.now())
+            if due:
+                self.idle()
+            upcoming = [s.due for s in self.schedules if s.due is not None]
+            timeout = self.config["status_interval"]
+            if upcoming:
+                timeout = min(timeout, max(0.0, (min(upcoming) - datetime.datetime.now()).total_seconds()))
+            try:
+                action = self.actions.get(timeout=timeout)
+            except queue.Empty:
+                action = None
+            if action is not None and not self.stopping.is_set():
+                self.run_action(action, self.config["motion"])
+                self.idle()
+            if time.monotonic() - last_status >= self.config["status_interval"]:
+                self.status()
+                last_status = time.monotonic()
+        self.shutdown()
+
+    def stop(self, *args):
+        self.stopping.set()
+        # Wake the loop up
+        try:
+            self.actions.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def shutdown(self):
+        print("Shutting down")
+        self.picam2.stop()
+        if self.metadata_recorder.enabled:
+            self.metadata_recorder.stop()
+        self.metadata_recorder.flush_queue.join()
+        self.image_writer.shutdown()
+        self.hdr_engine.shutdown()
+        self.status()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the camera unattended from a session config")
+    parser.add_argument("config", help="JSON session config")
+    parser.add_argument("--fake", action="store_true", help="Use the fake camera whatever the config says")
+    parser.add_argument("--replay", help="Replay a recorded session through the fake camera")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if args.fake or args.replay:
+        config["camera"] = "fake"
+    if args.replay:
+        config["replay"] = args.replay
+    daemon = captureDaemon(config)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    signal.signal(signal.SIGINT, daemon.stop)
+    daemon.run()
@@ -0,0 +1,167 @@
+#!/usr/bin/python3
+
+import queue
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from motion import lores_y
+
+try:
+    import onnxruntime
+    onnx_present = True
+except ImportError:
+    onnx_present = False
+
+
+def resize_nearest(y, size):
+    # Cheap nearest neighbour resize of a 2D plane to (w, h), without needing OpenCV
+    w, h = size
+    rows = np.arange(h) * y.shape[0] // h
+    cols = np.arange(w) * y.shape[1] // w
+    return y[rows[:, None], cols]
+
+
+class stubBackend:
+    # Stands in for a real model. Reports the brightest grid cell as a "snail", after
+    # pretending to think for infer_time seconds per frame.
+    def __init__(self, infer_time=0.02, grid=16):
+        self.infer_time = infer_time
+        self.grid = grid
+
+    def infer(self, frames):
+        time.sleep(self.infer_time * len(frames))
+        results = []
+        for y in frames:
+            g = self.grid
+            h, w = y.shape[0] // g * g, y.shape[1] // g * g
+            cells = y[:h, :w].reshape(h // g, g, w // g, g).mean(axis=(1, 3))
+            r, c = np.unravel_index(np.argmax(cells), cells.shape)
+            box = (c * g / y.shape[1], r * g / y.shape[0], (c + 1) * g / y.shape[1], (r + 1) * g / y.shape[0])
+            results.append([(*box, float(cells[r, c]) / 255, 0)])
+        return results
+
+
+class onnxBackend:
+    # Runs an ONNX model with ONNX Runtime on the CPU. The model takes a float32 NCHW batch
+    # scaled to 0-1, and gives back (N, K, 6) boxes of normalised x1, y1, x2, y2, score, class.
+    def __init__(self, model_path, input_size=(320, 320), score_threshold=0.5, threads=2):
+        if not onnx_present:
+            raise RuntimeError("onnxruntime not found - install it to run a detector model")
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.input_size = input_size
+        self.score_threshold = score_threshold
+
+    def infer(self, frames):
+        w, h = self.input_size
+        batch = np.empty((len(frames), 3, h, w), dtype=np.float32)
+        for i, y in enumerate(frames):
+            batch[i] = resize_nearest(y, self.input_size)
+        batch *= 1.0 / 255
+        output = self.session.run(None, {self.input_name: batch})[0]
+        return [[tuple(float(v) for v in box) for box in boxes if box[4] >= self.score_threshold]
+                for boxes in output]
+
+
+class detectorStage:
+    # Runs a detector backend over lores frames on its own thread. Frames arriving while
+    # the queue is full are dropped, and if inference can't keep up with the camera only
+    # every (skip + 1)th frame is queued at all, with skip adjusted as timings come in.
+    def __init__(self, backend, batch_size=4, max_queue=8, on_detections=None, history=100):
+        self.backend = backend
+        self.batch_size = batch_size
+        # on_detections(timestamp, boxes) is called from the worker for each frame
+        self.on_detections = on_detections
+        self.frames_queue = queue.Queue(maxsize=max_queue)
+        self.enabled = False
+        self.skip = 0
+        self.frame_count = 0
+        self.submitted = 0
+        self.processed = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.frame_interval = None
+        # Inference seconds per frame, and seconds from camera to result
+        self.infer_times = deque(maxlen=history)
+        self.latencies = deque(maxlen=history)
+        self.started = time.monotonic()
+        self.latest = (None, [])
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    @property
+    def stats(self):
+        elapsed = time.monotonic() - self.started
+        return {
+            "throughput": self.processed / elapsed if elapsed else 0.0,
+            "latency": float(np.mean(self.latencies)) if self.latencies else None,
+            "infer_time": float(np.mean(self.infer_times)) if self.infer_times else None,
+            "skip": self.skip,
+            "skipped": self.skipped,
+            "dropped": self.dropped,
+            "processed": self.processed,
+        }
+
+    def reset_stats(self):
+        self.submitted = self.processed = self.skipped = self.dropped = 0
+        self.infer_times.clear()
+        self.latencies.clear()
+        self.started = time.monotonic()
+
+    def submit(self, request):
+        # Called from post_callback on the camera thread
+        if not self.enabled:
+            return
+        metadata = request.get_metadata()
+        self.frame_interval = metadata["FrameDuration"] / 1e6
+        self.frame_count += 1
+        if self.frame_count % (self.skip + 1):
+            self.skipped += 1
+            return
+        if self.frames_queue.full():
+            self.dropped += 1
+            return
+        y = lores_y(request)
+        if y is None:
+            return
+        self.submitted += 1
+        try:
+            self.frames_queue.put_nowait((y, metadata["SensorTimestamp"], time.monotonic()))
+        except queue.Full:
+            self.dropped += 1
+
+    def adapt(self):
+        # Only look at as many frames as inference can get through in real time
+        if not self.infer_times or not self.frame_interval:
+            return
+        per_frame = float(np.mean(self.infer_times))
+        self.skip = max(0, int(np.ceil(per_frame / self.frame_interval)) - 1)
+
+    def run(self):
+        while True:
+            batch = [self.frames_queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.frames_queue.get_nowait())
+                except queue.Empty:
+                    break
+            start = time.monotonic()
+            try:
+                results = self.backend.infer([y for y, _, _ in batch])
+            except Exception as e:
+                print("Detector failed:", e)
+                continue
+            done = time.monotonic()
+            self.infer_times.append((done - start) / len(batch))
+            for (_, timestamp, queued), boxes in zip(batch, results):
+                self.latencies.append(done - queued)
+                self.processed += 1
+                self.latest = (timestamp, boxes)
+                if self.on_detections is not None:
+                    self.on_detections(timestamp, boxes)
+            self.adapt()
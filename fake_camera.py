@@ -0,0 +1,574 @@
+#!/usr/bin/python3
+
+import argparse
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+# The sensor modes the rig's camera offers, as listed in the README
+default_sensor_modes = [
+    ((1280, 720), 120.0, (1048, 1042, 2560, 1440)),
+    ((1920, 1080), 60.0, (408, 674, 3840, 2160)),
+    ((2328, 1748), 30.0, (0, 0, 4656, 3496)),
+    ((3840, 2160), 18.0, (408, 672, 3840, 2160)),
+    ((4656, 3496), 9.0, (0, 0, 4656, 3496)),
+]
+
+
+class fakeSensorFormat:
+    def __init__(self, format):
+        self.format = format
+
+    def __repr__(self):
+        return self.format
+
+
+class fakeStreamConfiguration:
+    def __init__(self, size, format):
+        self.size = tuple(size)
+        self.format = format
+
+    @property
+    def stride(self):
+        if self.format == "RGB888":
+            return self.size[0] * 3
+        if self.format.startswith("S"):
+            return self.size[0] * 2
+        return self.size[0]
+
+    def make_dict(self):
+        return {"size": self.size, "format": self.format, "stride": self.stride}
+
+
+class fakeConfiguration:
+    # Stands in for picamera2's CameraConfiguration
+    def __init__(self, main, lores=None, raw=None, buffer_count=4, controls=None, **kwargs):
+        self.main = fakeStreamConfiguration(main.get("size", (640, 480)), main.get("format", "RGB888"))
+        self.lores = fakeStreamConfiguration(lores["size"], "YUV420") if lores else None
+        self.raw = fakeStreamConfiguration(raw["size"], raw.get("format", "SRGGB10")) if raw else None
+        self.buffer_count = buffer_count
+        self.controls = dict(controls) if controls else {}
+        self.options = kwargs
+
+    def make_dict(self):
+        return {
+            "main": self.main.make_dict(),
+            "lores": self.lores.make_dict() if self.lores else None,
+            "raw": self.raw.make_dict() if self.raw else None,
+            "buffer_count": self.buffer_count,
+            "controls": self.controls,
+            **self.options,
+        }
+
+
+class fakeControls:
+    # picam2.controls.ExposureTime = ..., or as a context manager
+    def __init__(self, picam2):
+        object.__setattr__(self, "picam2", picam2)
+
+    def __setattr__(self, name, value):
+        self.picam2.set_controls({name: value})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class fakeHelpers:
+    # The parts of picamera2's Helpers the app uses, with PIL for encoding
+    def make_array(self, buffer, config):
+        w, h = config["size"]
+        stride = config["stride"]
+        if config["format"] == "YUV420":
+            return buffer.reshape((h * 3 // 2, stride))
+        if config["format"] == "RGB888":
+            return buffer.reshape((h, stride))[:, :w * 3].reshape((h, w, 3))
+        return buffer.reshape((h, stride)).view(np.uint16)[:, :w]
+
+    def make_image(self, buffer, config):
+        from PIL import Image
+        # RGB888 is BGR in memory, as with the real camera
+        return Image.fromarray(self.make_array(buffer, config)[:, :, ::-1])
+
+    def save(self, img, metadata, filename, format=None):
+        img.save(filename, format=format)
+
+    def save_dng(self, buffer, metadata, config, filename):
+        # No DNG writer here, so keep the raw samples and metadata as they are
+        with open(filename, "wb") as f:
+            f.write(buffer.tobytes())
+        with open(f"{filename}.json", "w") as f:
+            json.dump({"config": config, "metadata": metadata}, f, default=str)
+
+
+class fakeRequest:
+    # A completed request. Arrays are only made when asked for, then kept.
+    def __init__(self, picam2, config, metadata, frame=None):
+        self.picam2 = picam2
+        self.config = config
+        self.metadata = metadata
+        self.frame = frame
+        self.arrays = {}
+        self.released = False
+
+    def get_metadata(self):
+        return dict(self.metadata)
+
+    def make_array(self, name):
+        if name not in self.arrays:
+            self.arrays[name] = self.picam2.render(name, self)
+        return self.arrays[name]
+
+    def make_buffer(self, name):
+        return np.ascontiguousarray(self.make_array(name)).reshape(-1).view(np.uint8).copy()
+
+    def save(self, name, filename):
+        helpers = self.picam2.helpers
+        helpers.save(helpers.make_image(self.make_buffer(name), self.config[name]), self.metadata, filename)
+
+    def save_dng(self, filename, name="raw"):
+        self.picam2.helpers.save_dng(self.make_buffer(name), self.metadata, self.config[name], filename)
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.picam2.outstanding -= 1
+
+
+class fakeJob:
+    def __init__(self, signal_function=None):
+        self.signal_function = signal_function
+        self.event = threading.Event()
+        self.result = None
+
+
+class fakeEncoder:
+    # Pretends to be an H.264 encoder. Each frame becomes a packet whose size follows the
+    # bitrate, with more bits for keyframes, handed to the output just like the real thing.
+    def __init__(self, bitrate=None, repeat=False, iperiod=30, framerate=30):
+        self.bitrate = bitrate
+        self.iperiod = iperiod
+        self.framerate = framerate
+        self.output = None
+        self.frames = 0
+        self.firsttimestamp = None
+
+    def start(self, quality=None):
+        if self.bitrate is None:
+            self.bitrate = 10_000_000
+        self.frames = 0
+        self.firsttimestamp = None
+        for output in self.outputs:
+            output.start()
+
+    def stop(self):
+        for output in self.outputs:
+            output.stop()
+
+    @property
+    def outputs(self):
+        # Like picamera2, output may be one output or a list of them
+        if self.output is None:
+            return []
+        return self.output if isinstance(self.output, list) else [self.output]
+
+    def encode(self, request):
+        keyframe = self.frames % self.iperiod == 0
+        size = max(1, int(self.bitrate / 8 / self.framerate * (4 if keyframe else 0.9)))
+        packet = bytes([0, 0, 0, 1, 0x65 if keyframe else 0x41]) + bytes(size)
+        self.frames += 1
+        # Like picamera2, outputs get microseconds since the first frame encoded, not the
+        # SensorTimestamp itself
+        timestamp = request.metadata["SensorTimestamp"] // 1000
+        if self.firsttimestamp is None:
+            self.firsttimestamp = timestamp
+        for output in self.outputs:
+            output.outputframe(packet, keyframe, timestamp - self.firsttimestamp)
+
+
+class fakeFileOutput:
+    # Stands in for picamera2's FileOutput, writing the packets straight to a file
+    def __init__(self, file=None):
+        self.file = file
+        self.handle = None
+
+    def start(self):
+        if self.file is not None:
+            self.handle = open(self.file, "wb")
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+    def outputframe(self, frame, keyframe=True, timestamp=None):
+        if self.handle is not None:
+            self.handle.write(frame)
+
+
+class fakePicamera2:
+    # A drop in for Picamera2 with no hardware. Frames are drawn on the fly (a textured
+    # arena with a slowly crawling blob), or replayed from a session saved by record_session.
+    # Controls take effect control_delay frames after they are set, as on the real camera.
+    # With realtime off, frames come as fast as they can be made.
+    def __init__(self, replay=None, realtime=True, control_delay=2, sensor_modes=None, model="fake"):
+        self.realtime = realtime
+        self.control_delay = control_delay
+        self.camera_properties = {"Model": model, "PixelArraySize": default_sensor_modes[-1][0]}
+        self.sensor_resolution = default_sensor_modes[-1][0]
+        self.sensor_modes_ = sensor_modes if sensor_modes is not None else [
+            {
+                "format": fakeSensorFormat("SRGGB10_CSI2P"), "unpacked": "SRGGB10", "bit_depth": 10,
+                "size": size, "fps": fps, "crop_limits": crop, "exposure_limits": (100, 1_000_000_000, None),
+            }
+            for size, fps, crop in default_sensor_modes
+        ]
+        self.helpers = fakeHelpers()
+        self.controls = fakeControls(self)
+        self.post_callback = None
+        self.pre_callback = None
+        self.encoders = set()
+        # Held while frames are encoded, so stop_encoder never closes an output mid-frame
+        self.encoder_lock = threading.Lock()
+        self.outstanding = 0
+        self.frames = 0
+        self.timestamp = time.monotonic_ns()
+        self.started = False
+        self.thread = None
+        self.lock = threading.Lock()
+        self.jobs = deque()
+        # Controls in force, and those still on their way (frame they land on, controls)
+        self.control_values = {
+            "AeEnable": True, "AwbEnable": True, "ExposureTime": 10000, "AnalogueGain": 1.0,
+            "ColourGains": (1.8, 1.6), "FrameDurationLimits": (33333, 33333),
+        }
+        self.pending_controls = deque()
+        self.replay = None
+        if replay is not None:
+            self.replay = sessionReplay(replay)
+        self.still_configuration = self.create_still_configuration()
+        self.video_configuration = self.create_video_configuration()
+        self.preview_configuration = self.create_preview_configuration()
+        self.camera_config = None
+        self.scenes = {}
+        self.configure("preview")
+
+    @property
+    def sensor_modes(self):
+        return self.sensor_modes_
+
+    @property
+    def camera_controls(self):
+        crop = self.full_crop
+        return {
+            "ExposureTime": (100, 1_000_000_000, 10000),
+            "AnalogueGain": (1.0, 16.0, 1.0),
+            "ExposureValue": (-8.0, 8.0, 0.0),
+            "ColourGains": (0.0, 32.0, None),
+            "Saturation": (0.0, 32.0, 1.0),
+            "Contrast": (0.0, 32.0, 1.0),
+            "Sharpness": (0.0, 16.0, 1.0),
+            "Brightness": (-1.0, 1.0, 0.0),
+            "NoiseReductionMode": (0, 4, 0),
+            "AeEnable": (False, True, None),
+            "AeMeteringMode": (0, 3, 0),
+            "AeConstraintMode": (0, 3, 0),
+            "AeExposureMode": (0, 3, 0),
+            "AwbEnable": (False, True, None),
+            "AwbMode": (0, 7, 0),
+            "ScalerCrop": ((0, 0, 64, 64), crop, crop),
+            "FrameDurationLimits": (8333, 1_000_000_000, None),
+            "AfMode": (0, 2, 0),
+            "LensPosition": (0.0, 15.0, 1.0),
+        }
+
+    def _create_configuration(self, main, lores, raw, buffer_count, controls, default_controls, **kwargs):
+        if raw is None or raw == {}:
+            raw = {"size": self.sensor_resolution}
+        # picamera2's defaults for each kind of configuration, under whatever was asked for
+        controls = dict(default_controls, **(controls or {}))
+        return fakeConfiguration(dict(main or {}), lores, raw, buffer_count, controls, **kwargs)
+
+    def create_still_configuration(self, main=None, lores=None, raw=None, buffer_count=1, controls=None, **kwargs):
+        main = dict(main or {})
+        main.setdefault("size", self.sensor_resolution)
+        # Long enough for any exposure, so stills and HDR brackets are not clamped
+        return self._create_configuration(
+            main, lores, raw, buffer_count, controls, {"FrameDurationLimits": (100, 1_000_000_000)}, **kwargs
+        )
+
+    def create_video_configuration(self, main=None, lores=None, raw=None, buffer_count=6, controls=None, **kwargs):
+        main = dict(main or {})
+        main.setdefault("size", (1280, 720))
+        return self._create_configuration(
+            main, lores, raw, buffer_count, controls, {"FrameDurationLimits": (33333, 33333)}, **kwargs
+        )
+
+    def create_preview_configuration(self, main=None, lores=None, raw=None, buffer_count=4, controls=None, **kwargs):
+        main = dict(main or {})
+        main.setdefault("size", (640, 480))
+        return self._create_configuration(
+            main, lores, raw, buffer_count, controls, {"FrameDurationLimits": (100, 83333)}, **kwargs
+        )
+
+    @property
+    def full_crop(self):
+        if self.camera_config is not None and self.camera_config.get("raw") is not None:
+            size = self.camera_config["raw"]["size"]
+            for mode in self.sensor_modes:
+                if tuple(mode["size"]) == tuple(size):
+                    return mode["crop_limits"]
+        return (0, 0, *self.sensor_resolution)
+
+    def configure(self, config):
+        if self.started:
+            raise RuntimeError("Camera must be stopped before configuring")
+        if isinstance(config, str):
+            config = getattr(self, f"{config}_configuration")
+        if self.replay is not None:
+            self.camera_config = self.replay.config
+        else:
+            self.camera_config = config.make_dict()
+        self.control_values.update(config.controls)
+
+    def set_controls(self, controls):
+        controls = dict(controls)
+        if "FrameRate" in controls:
+            duration = int(1e6 / controls.pop("FrameRate"))
+            controls["FrameDurationLimits"] = (duration, duration)
+        with self.lock:
+            self.pending_controls.append((self.frames + self.control_delay, controls))
+
+    def start(self):
+        if self.started:
+            return
+        self.started = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.started:
+            return
+        self.started = False
+        self.thread.join()
+
+    def close(self):
+        self.stop()
+
+    def start_encoder(self, encoder, output=None, pts=None, quality=None, name=None):
+        # Same arguments as picamera2, where the third is pts rather than quality
+        if output is not None:
+            encoder.output = output
+        encoder.start(quality)
+        self.encoders.add(encoder)
+
+    def stop_encoder(self, encoders=None):
+        if encoders is None:
+            encoders = set(self.encoders)
+        elif not isinstance(encoders, (set, list, tuple)):
+            encoders = {encoders}
+        with self.encoder_lock:
+            for encoder in encoders:
+                self.encoders.discard(encoder)
+                encoder.stop()
+
+    def capture_request(self, wait=None, signal_function=None, flush=None):
+        job = fakeJob(signal_function)
+        with self.lock:
+            self.jobs.append(job)
+        if signal_function is not None:
+            return job
+        return self.wait(job)
+
+    def wait(self, job, timeout=None):
+        job.event.wait(timeout)
+        return job.result
+
+    def get_metadata(self):
+        return self.capture_metadata()
+
+    def capture_metadata(self):
+        request = self.capture_request()
+        metadata = request.get_metadata()
+        request.release()
+        return metadata
+
+    def capture_array(self, name="main"):
+        request = self.capture_request()
+        array = request.make_array(name).copy()
+        request.release()
+        return array
+
+    def frame_metadata(self):
+        # Bring in any controls due on this frame, and work out what the frame looks like
+        with self.lock:
+            while self.pending_controls and self.pending_controls[0][0] <= self.frames:
+                self.control_values.update(self.pending_controls.popleft()[1])
+        c = self.control_values
+        lower, upper = c["FrameDurationLimits"]
+        if c["AeEnable"]:
+            # The AEC settles on 30fps where the limits allow
+            exposure, gain = min(10000, upper), 1.0
+            duration = min(max(lower, 33333), upper)
+        else:
+            # The frame stretches to fit the exposure, up to the upper limit
+            exposure, gain = min(int(c["ExposureTime"]), upper), float(c["AnalogueGain"])
+            duration = min(max(lower, exposure), upper)
+        duration = max(duration, 8333)
+        return {
+            "SensorTimestamp": self.timestamp, "FrameDuration": duration, "ExposureTime": exposure,
+            "AnalogueGain": gain, "DigitalGain": 1.0, "ColourGains": tuple(c["ColourGains"]),
+            "ColourTemperature": 4500, "Lux": 400.0 * exposure * gain / 10000, "AeLocked": True,
+            "ScalerCrop": c.get("ScalerCrop", self.full_crop), "SensorTemperature": 40.0,
+        }
+
+    def next_request(self):
+        if self.replay is not None:
+            metadata, frame = self.replay.next()
+            metadata = dict(metadata, SensorTimestamp=self.timestamp)
+            return fakeRequest(self, self.camera_config, metadata, frame)
+        return fakeRequest(self, self.camera_config, self.frame_metadata())
+
+    def scene(self, name, config):
+        # The static part of a frame, made once per stream size
+        key = (name, config["size"], config["format"])
+        if key not in self.scenes:
+            w, h = config["size"]
+            yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+            texture = 96 + 40 * np.sin(xx / 23.0) * np.cos(yy / 31.0) + 40 * (xx / w)
+            self.scenes[key] = texture.astype(np.uint8)
+        return self.scenes[key]
+
+    def render(self, name, request):
+        config = request.config[name]
+        if request.frame is not None and name in request.frame:
+            return request.frame[name]
+        w, h = config["size"]
+        metadata = request.metadata
+        # Brightness follows exposure and gain, around a nominal 10ms at unity gain
+        scale = metadata["ExposureTime"] * metadata["AnalogueGain"] / 10000
+        lut = np.clip(np.arange(256, dtype=np.float32) * scale, 0, 255).astype(np.uint8)
+        y = lut[self.scene(name, config)]
+        # The "snail", crawling a lap of the arena every few minutes
+        t = metadata["SensorTimestamp"] / 1e9
+        cx = int((0.5 + 0.35 * np.cos(t / 30)) * w)
+        cy = int((0.5 + 0.35 * np.sin(t / 30)) * h)
+        r = max(2, w // 40)
+        y[max(cy - r, 0):cy + r, max(cx - r, 0):cx + r] = lut[40]
+        if config["format"] == "YUV420":
+            out = np.full((h * 3 // 2, config["stride"]), 128, dtype=np.uint8)
+            out[:h, :w] = y
+            return out
+        if config["format"] == "RGB888":
+            return np.repeat(y[:, :, None], 3, axis=2)
+        return y.astype(np.uint16) << 2
+
+    def run(self):
+        while self.started:
+            start = time.monotonic()
+            request = self.next_request()
+            self.outstanding += 1
+            self.frames += 1
+            duration = request.metadata["FrameDuration"]
+            if self.post_callback is not None:
+                self.post_callback(request)
+            with self.encoder_lock:
+                for encoder in list(self.encoders):
+                    encoder.encode(request)
+            with self.lock:
+                jobs = list(self.jobs)
+                self.jobs.clear()
+            for job in jobs:
+                # Every waiter gets its own reference to the frame
+                job.result = request if job is jobs[-1] else fakeRequest(
+                    self, request.config, request.metadata, request.frame)
+                if job is not jobs[-1]:
+                    job.result.arrays = request.arrays
+                    self.outstanding += 1
+                job.event.set()
+                if job.signal_function is not None:
+                    job.signal_function(job)
+            if not jobs:
+                request.release()
+            self.timestamp += duration * 1000
+            if self.realtime:
+                time.sleep(max(0.0, duration / 1e6 - (time.monotonic() - start)))
+
+
+class sessionReplay:
+    # Frames and metadata saved by record_session, handed out in order and looped
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, "session.json")) as f:
+            session = json.load(f)
+        # Streams that were not recorded are None, as in a live configuration without them
+        self.config = {name: None for name in ("main", "lores", "raw")}
+        self.config.update({
+            name: (dict(c, size=tuple(c["size"])) if c is not None else None)
+            for name, c in session["config"].items()
+        })
+        with open(os.path.join(directory, "metadata.jsonl")) as f:
+            self.metadata = [json.loads(line) for line in f]
+        self.index = 0
+
+    def next(self):
+        i = self.index % len(self.metadata)
+        self.index += 1
+        with np.load(os.path.join(self.directory, f"{i:06d}.npz")) as frame:
+            return self.metadata[i], dict(frame)
+
+
+def record_session(picam2, directory, frames=100, streams=("main", "lores")):
+    # Save frames and metadata from a running camera, real or fake, for replaying later
+    os.makedirs(directory, exist_ok=True)
+    streams = [s for s in streams if picam2.camera_config.get(s) is not None]
+    # Every stream gets an entry, None for those not recorded, so the replayed configuration
+    # has the same keys as a live one
+    config = {s: None for s in ("main", "lores", "raw")}
+    config.update({s: {
+        "size": picam2.camera_config[s]["size"], "format": picam2.camera_config[s]["format"],
+        "stride": picam2.camera_config[s]["stride"]} for s in streams})
+    with open(os.path.join(directory, "session.json"), "w") as f:
+        json.dump({"config": config}, f)
+    with open(os.path.join(directory, "metadata.jsonl"), "w") as f:
+        for i in range(frames):
+            request = picam2.capture_request()
+            try:
+                np.savez(os.path.join(directory, f"{i:06d}.npz"), **{s: request.make_array(s) for s in streams})
+                f.write(json.dumps(request.get_metadata(), default=list) + "\n")
+            finally:
+                request.release()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record a session from the camera, or replay one to time it")
+    parser.add_argument("mode", choices=["record", "replay", "synthetic"])
+    parser.add_argument("directory", nargs="?")
+    parser.add_argument("--frames", type=int, default=100)
+    args = parser.parse_args()
+
+    if args.mode == "record":
+        from picamera2 import Picamera2
+        from motion import lores_size_for
+        camera = Picamera2()
+        camera.configure(camera.create_video_configuration(lores={"size": lores_size_for((1280, 720))}))
+        camera.start()
+        record_session(camera, args.directory, args.frames)
+        camera.stop()
+    else:
+        camera = fakePicamera2(replay=args.directory if args.mode == "replay" else None, realtime=False)
+        camera.start()
+        start = time.perf_counter()
+        for _ in range(args.frames):
+            request = camera.capture_request()
+            request.make_array("main")
+            request.release()
+        elapsed = time.perf_counter() - start
+        camera.stop()
+        print(f"{args.frames} frames in {elapsed:.2f}s, {args.frames / elapsed:.1f} frames/s")
@@ -0,0 +1,23 @@
+#!/usr/bin/python3
+
+import os
+import re
+from contextlib import contextmanager
+
+
+def safe_name(text):
+    # text with anything that doesn't belong in a filename replaced
+    return re.sub(r"[^A-Za-z0-9_.-]", "_", text)
+
+
+@contextmanager
+def atomic_path(path, suffix=""):
+    # A temporary path to write in place of path, renamed over it once the with block ends.
+    # A crash part way never leaves half a file, and a reader never sees one.
+    tmp_path = f"{path}.{os.getpid()}.tmp{suffix}"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
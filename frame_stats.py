@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class rollingSamples:
+    # Fixed size ring of the most recent float samples, preallocated
+    def __init__(self, size):
+        self.samples = np.zeros(size, dtype=np.float64)
+        self.index = 0
+        self.count = 0
+
+    def append(self, value):
+        self.samples[self.index] = value
+        self.index = (self.index + 1) % len(self.samples)
+        self.count = min(self.count + 1, len(self.samples))
+
+    @property
+    def values(self):
+        return self.samples[:self.count]
+
+    def clear(self):
+        self.index = 0
+        self.count = 0
+
+    def summary(self):
+        values = self.values
+        if not len(values):
+            return None
+        return {
+            "mean": float(values.mean()),
+            "std": float(values.std()),
+            "min": float(values.min()),
+            "max": float(values.max()),
+            "p99": float(np.percentile(values, 99)),
+        }
+
+    def histogram(self, bins=10):
+        # (counts, bin edges) over the samples held
+        return np.histogram(self.values, bins=bins)
+
+
+class phaseTimer:
+    # Wall clock time of each phase of something like startup, one after another
+    def __init__(self, start=None):
+        self.start = start if start is not None else time.perf_counter()
+        self.last = self.start
+        self.phases = {}
+
+    def mark(self, name):
+        # The phase called name has just finished
+        now = time.perf_counter()
+        self.phases[name] = self.phases.get(name, 0.0) + now - self.last
+        self.last = now
+
+    @property
+    def total(self):
+        return self.last - self.start
+
+    def report(self):
+        return ", ".join(f"{k} {v * 1000:.0f}ms" for k, v in self.phases.items()) + \
+            f", total {self.total * 1000:.0f}ms"
+
+
+class frameStats:
+    # Inter-frame timing from SensorTimestamp, and how long callbacks take. A gap of more
+    # than gap_factor frame durations between timestamps counts as dropped frames.
+    def __init__(self, history=600, gap_factor=1.5):
+        self.history = history
+        self.gap_factor = gap_factor
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            # Milliseconds between frames
+            self.intervals = rollingSamples(self.history)
+            # Milliseconds spent in each timed callback
+            self.callbacks = {}
+            self.last_timestamp = None
+            self.frames = 0
+            self.gaps = 0
+            self.dropped = 0
+
+    def frame(self, metadata):
+        # Called from post_callback on the camera thread
+        timestamp = metadata["SensorTimestamp"]
+        expected = metadata["FrameDuration"] * 1000
+        with self.lock:
+            self.frames += 1
+            if self.last_timestamp is not None:
+                delta = timestamp - self.last_timestamp
+                self.intervals.append(delta / 1e6)
+                if delta > self.gap_factor * expected:
+                    self.gaps += 1
+                    self.dropped += int(round(delta / expected)) - 1
+            self.last_timestamp = timestamp
+
+    @contextmanager
+    def timed(self, name):
+        # with frame_stats.timed("post_callback"): ...
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            with self.lock:
+                if name not in self.callbacks:
+                    self.callbacks[name] = rollingSamples(self.history)
+                self.callbacks[name].append(elapsed)
+
+    @property
+    def stats(self):
+        with self.lock:
+            intervals = self.intervals.summary()
+            return {
+                "frames": self.frames,
+                "gaps": self.gaps,
+                "dropped": self.dropped,
+                "interval_ms": intervals,
+                "jitter_ms": intervals["std"] if intervals else None,
+                "callbacks_ms": {k: v.summary() for k, v in self.callbacks.items()},
+            }
+
+    def histogram(self, name=None, bins=10):
+        # Inter-frame time histogram, or that of a timed callback by name
+        with self.lock:
+            samples = self.intervals if name is None else self.callbacks.get(name)
+            if samples is None or not samples.count:
+                return None
+            return samples.histogram(bins)
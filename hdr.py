@@ -0,0 +1,355 @@
+#!/usr/bin/python3
+
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from files import atomic_path, safe_name
+
+# Everything the engine knows how to produce, in the order they used to be written
+merge_methods = ["mean", "debevec", "robertson", "mertens"]
+
+# Rows shared between neighbouring tiles, so Mertens' pyramids don't leave seams
+tile_overlap = 64
+
+
+def working_bytes_per_pixel(method, number):
+    # Rough estimate of the float32 working memory OpenCV needs per pixel for a bracket
+    if method == "mean":
+        return 3 * 4
+    if method == "mertens":
+        # Weights, float copies and the Laplacian pyramids of every frame
+        return number * 3 * 4 * 4 + 3 * 4 * 3
+    return number * 3 * 4 + 3 * 4 * 3
+
+
+def tile_rows(method, shape, max_memory):
+    # How many rows of the bracket can be merged at once within max_memory bytes
+    number, height, width, _ = shape
+    rows = int(max_memory // (width * working_bytes_per_pixel(method, number)))
+    return min(height, max(rows, 2 * tile_overlap + 16))
+
+
+# Camera response curves only depend on the sensor, its mode and gain, so are worked out once
+# and kept here
+response_dir = os.path.join(os.path.expanduser("~"), ".cache", "snailcam", "responses")
+# Calibration only samples the bracket, so a downscaled copy of around this many pixels is plenty
+calibration_pixels = 1_000_000
+
+
+def response_key(model, sensor_mode, gain):
+    # Name for a response curve. sensor_mode is a picTab.sensor_mode dict ({} for the default)
+    if sensor_mode:
+        mode = f"{sensor_mode['format']}_{sensor_mode['size'][0]}x{sensor_mode['size'][1]}"
+    else:
+        mode = "default"
+    return safe_name(f"{model}_{mode}_gain{gain:.1f}")
+
+
+def response_path(method, key):
+    return os.path.join(response_dir, f"{key}_{method}.npy")
+
+
+def clear_responses(key):
+    # Forget the curves for key, so the next bracket recalibrates
+    for method in ("debevec", "robertson"):
+        try:
+            os.remove(response_path(method, key))
+        except FileNotFoundError:
+            pass
+
+
+def camera_response(method, stack, exposures, key):
+    # Load the cached response curve for method, calibrating it from this bracket if needed
+    import cv2
+    path = response_path(method, key)
+    if os.path.exists(path):
+        return np.load(path)
+    _, height, width, _ = stack.shape
+    step = max(1, int(np.sqrt(height * width / calibration_pixels)))
+    images = [np.ascontiguousarray(frame[::step, ::step]) for frame in stack]
+    start = time.perf_counter()
+    if method == "debevec":
+        response = cv2.createCalibrateDebevec().process(images, times=exposures)
+    else:
+        response = cv2.createCalibrateRobertson().process(images, times=exposures)
+    print(f"Calibrated {method} response for {key} in {time.perf_counter() - start:.2f}s")
+    os.makedirs(response_dir, exist_ok=True)
+    # A merge running alongside never reads half a file
+    with atomic_path(path, ".npy") as tmp_path:
+        np.save(tmp_path, response)
+    return response
+
+
+def _merge_hdr(method, images, exposures, response):
+    import cv2
+    merger = cv2.createMergeDebevec() if method == "debevec" else cv2.createMergeRobertson()
+    if response is None:
+        return merger.process(images, times=exposures)
+    return merger.process(images, times=exposures, response=response)
+
+
+def merge(method, stack, exposures, gamma, response=None):
+    # Run a single merge over an (N, H, W, 3) uint8 stack, returning an 8 bit BGR image
+    import cv2
+    images = list(stack)
+    if method == "mean":
+        mean_image = np.mean(stack, axis=0, dtype=np.float32)
+        return mean_image.astype('uint8')
+    if method == "mertens":
+        res = cv2.createMergeMertens().process(images)
+        return np.clip(res * 255, 0, 255).astype('uint8')
+    if method in ("debevec", "robertson"):
+        hdr = _merge_hdr(method, images, exposures, response)
+    else:
+        raise ValueError(f"Unknown HDR merge method {method}")
+    res = cv2.createTonemap(gamma=gamma).process(hdr)
+    return np.clip(res * 255, 0, 255).astype('uint8')
+
+
+def merge_tiled(method, stack, exposures, gamma, filename, max_memory, response=None):
+    # Same results as merge(), but only max_memory bytes of the working set are alive at once.
+    # Intermediate and final images live in memory mapped files next to the output, so the
+    # kernel can page them out rather than the Pi running out of memory.
+    import cv2
+    number, height, width, _ = stack.shape
+    rows = tile_rows(method, stack.shape, max_memory)
+    out_path = f"{filename}.tmp.npy"
+    out = np.lib.format.open_memmap(out_path, mode="w+", dtype=np.uint8, shape=(height, width, 3))
+    try:
+        if method == "mean":
+            # Accumulate in float32, in place, one tile at a time
+            acc = np.empty((rows, width, 3), dtype=np.float32)
+            for y in range(0, height, rows):
+                tile = acc[:min(rows, height - y)]
+                tile[...] = stack[0, y:y + len(tile)]
+                for frame in stack[1:]:
+                    np.add(tile, frame[y:y + len(tile)], out=tile)
+                tile *= 1.0 / number
+                out[y:y + len(tile)] = tile
+        elif method == "mertens":
+            merge_mertens = cv2.createMergeMertens()
+            step = rows - tile_overlap
+            ramp = np.linspace(0, 1, tile_overlap, dtype=np.float32)[:, None, None]
+            for y in range(0, height, step):
+                end = min(y + rows, height)
+                res = merge_mertens.process(list(stack[:, y:end]))
+                res = np.clip(res * 255, 0, 255)
+                if y:
+                    # Feather into the rows the previous tile already wrote
+                    overlap = min(tile_overlap, end - y)
+                    res[:overlap] = out[y:y + overlap] * (1 - ramp[:overlap]) + res[:overlap] * ramp[:overlap]
+                out[y:end] = res
+                if end == height:
+                    break
+        else:
+            hdr_path = f"{filename}.hdr.tmp.npy"
+            hdr = np.lib.format.open_memmap(hdr_path, mode="w+", dtype=np.float32, shape=(height, width, 3))
+            try:
+                # These merges are per pixel, so tiles need no overlap. The tonemap normalises
+                # by the global range though, so find that on the first pass.
+                lo, hi = np.inf, -np.inf
+                for y in range(0, height, rows):
+                    res = _merge_hdr(method, list(stack[:, y:y + rows]), exposures, response)
+                    hdr[y:y + rows] = res
+                    lo = min(lo, float(res.min()))
+                    hi = max(hi, float(res.max()))
+                scale = 1.0 / (hi - lo) if hi - lo > np.finfo(np.float32).eps else 1.0
+                for y in range(0, height, rows):
+                    tile = np.array(hdr[y:y + rows])
+                    tile -= lo
+                    tile *= scale
+                    np.power(tile, 1.0 / gamma, out=tile)
+                    tile *= 255
+                    out[y:y + rows] = np.clip(tile, 0, 255, out=tile)
+            finally:
+                del hdr
+                os.remove(hdr_path)
+        out.flush()
+        cv2.imwrite(filename, out)
+    finally:
+        del out
+        os.remove(out_path)
+    return rows * width * working_bytes_per_pixel(method, number)
+
+
+def _memory_status():
+    # VmRSS, VmHWM and RssShmem of this process in bytes, or None where /proc can't say
+    try:
+        with open("/proc/self/status") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+        return {k: int(fields[k].split()[0]) * 1024 for k in ("VmRSS", "VmHWM", "RssShmem")}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def _reset_peak():
+    # Start VmHWM again from the current RSS, so it only covers what comes next
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _merge_worker(method, shm_name, shape, exposures, gamma, filename, max_memory, key):
+    # Runs in a pool process. The bracket is read straight out of shared memory, never pickled
+    import cv2
+    shm = shared_memory.SharedMemory(name=shm_name)
+    # The parent owns (and unlinks) the block, so stop this process' tracker claiming it too
+    resource_tracker.unregister(shm._name, "shared_memory")
+    try:
+        stack = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        before = _memory_status() if _reset_peak() else None
+        start = time.perf_counter()
+        response = None
+        if key is not None and method in ("debevec", "robertson"):
+            response = camera_response(method, stack, exposures, key)
+        if max_memory:
+            working = merge_tiled(method, stack, exposures, gamma, filename, max_memory, response)
+        else:
+            result = merge(method, stack, exposures, gamma, response)
+            cv2.imwrite(filename, result)
+            working = shape[1] * shape[2] * working_bytes_per_pixel(method, shape[0])
+            del result
+        del stack
+        # How far this merge took the worker's own memory above where it started. The pages
+        # of the shared bracket it read are left out, as are earlier merges in this worker.
+        peak = None
+        after = _memory_status()
+        if before is not None and after is not None:
+            peak = max(after["VmHWM"] - after["RssShmem"] - (before["VmRSS"] - before["RssShmem"]), 0)
+        return method, time.perf_counter() - start, working, peak
+    finally:
+        shm.close()
+
+
+def _warm_up():
+    return None
+
+
+class hdrBracket:
+    # The frames of one bracket, captured straight into shared memory the merge workers read,
+    # so each frame is only ever held once
+    def __init__(self, number, shape):
+        self.shape = (number, *shape)
+        self.shm = shared_memory.SharedMemory(create=True, size=int(np.prod(self.shape)))
+        self.stack = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+
+    @property
+    def nbytes(self):
+        return self.shm.size
+
+    def release(self):
+        # Any views of the stack must be gone before the block can be closed
+        del self.stack
+        self.shm.close()
+        self.shm.unlink()
+
+
+class hdrEngine:
+    def __init__(self, workers=None):
+        self.workers = workers if workers else min(len(merge_methods), multiprocessing.cpu_count())
+        self.pool = None
+        # Last time taken by each method in seconds, so slow ones can be dropped
+        self.timings = {}
+        # Working set of each method's merge (or its tiles) in bytes, and how far the merge
+        # raised its worker's memory, or None where that can't be measured
+        self.peak_memory = {}
+        self.busy = 0
+        self.lock = threading.Lock()
+
+    def start(self):
+        # Fork the workers now, before the camera and Qt start any threads of their own
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"))
+            for future in [self.pool.submit(_warm_up) for _ in range(self.workers)]:
+                future.result()
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
+
+    def process(self, bracket, exposures, methods, gamma, filenames, done=None, max_memory=None, key=None):
+        # bracket is an hdrBracket (or a list of same sized BGR frames) and exposures their
+        # times in seconds. filenames maps each method to where its result is written. With
+        # max_memory (bytes) set, every merge runs tile by tile within roughly that budget.
+        # key (see response_key) picks the cached camera response Debevec/Robertson use.
+        # Returns straight away, calling done(timings) from a helper thread once every
+        # selected merge has finished. The engine releases the bracket when it is done with it.
+        methods = [m for m in merge_methods if m in methods]
+        if not isinstance(bracket, hdrBracket):
+            images = bracket
+            bracket = hdrBracket(len(images), images[0].shape)
+            for i, img in enumerate(images):
+                bracket.stack[i] = img
+        if not methods:
+            print("No HDR merge methods selected")
+            bracket.release()
+            return
+        exposures = np.asarray(exposures, dtype=np.float32)
+
+        def submit():
+            self.start()
+            return [
+                self.pool.submit(
+                    _merge_worker, method, bracket.shm.name, bracket.shape, exposures, gamma,
+                    filenames[method], max_memory, key
+                )
+                for method in methods
+            ]
+
+        try:
+            try:
+                futures = submit()
+            except BrokenProcessPool:
+                # A worker died (such as to the OOM killer during a big merge) and took the pool
+                # with it, so start a new one and try once more
+                print("HDR workers died, starting new ones")
+                self.pool.shutdown(wait=False)
+                self.pool = None
+                futures = submit()
+        except Exception:
+            bracket.release()
+            raise
+        with self.lock:
+            self.busy += 1
+        start = time.perf_counter()
+
+        def wait_for_merges():
+            timings = {}
+            try:
+                for future in as_completed(futures):
+                    try:
+                        method, seconds, working, peak = future.result()
+                    except Exception as e:
+                        print("HDR merge failed:", e)
+                        continue
+                    timings[method] = seconds
+                    self.peak_memory[method] = (working, peak)
+                    print(
+                        f"{method.capitalize()} Done in {seconds:.2f}s, working set {working / 2**20:.0f}MB"
+                        + (f" (budget {max_memory / 2**20:.0f}MB)" if max_memory else "")
+                        + (f", merge peak +{peak / 2**20:.0f}MB" if peak is not None else "")
+                    )
+            finally:
+                bracket.release()
+                with self.lock:
+                    self.busy -= 1
+            self.timings.update(timings)
+            print(
+                f"Saved All HDR Images in {time.perf_counter() - start:.2f}s, "
+                f"bracket {bracket.nbytes / 2**20:.0f}MB", timings
+            )
+            if done is not None:
+                done(timings)
+
+        threading.Thread(target=wait_for_merges, daemon=True).start()
@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+
+import time
+
+from PyQt5.QtCore import QObject, Qt, pyqtSignal
+from PyQt5.QtWidgets import (QCheckBox, QDoubleSpinBox, QFormLayout, QLabel,
+                             QVBoxLayout, QWidget)
+
+from metadata_format import format_row, sort_key
+
+
+class metadataFeed(QObject):
+    # Hands metadata from the camera thread to the GUI thread. post_callback only stores the
+    # latest metadata, and a signal goes out at most rate times a second and never while the
+    # last one is still waiting to be handled, so a busy GUI just sees fewer, newer updates.
+    updated = pyqtSignal()
+
+    def __init__(self, rate=5.0):
+        super().__init__()
+        self.rate = rate
+        self.latest = None
+        self.pending = False
+        self.last_sent = 0.0
+
+    def push(self, metadata):
+        # Called from post_callback on the camera thread
+        self.latest = metadata
+        now = time.monotonic()
+        if not self.pending and now - self.last_sent >= 1.0 / self.rate:
+            self.pending = True
+            self.last_sent = now
+            self.updated.emit()
+
+    def take(self):
+        # Called from the GUI thread when handling updated
+        self.pending = False
+        return self.latest
+
+
+class infoTab(QWidget):
+    # One label per metadata key, and only the ones whose value changed are re-rendered
+    def __init__(self, feed, recorder=None):
+        super().__init__()
+        self.feed = feed
+        self.recorder = recorder
+        self.layout = QVBoxLayout()
+        self.layout.setAlignment(Qt.AlignTop)
+        self.setLayout(self.layout)
+
+        self.rate = QDoubleSpinBox()
+        self.rate.setRange(0.5, 60.0)
+        self.rate.setValue(feed.rate)
+        self.rate.valueChanged.connect(lambda: setattr(self.feed, "rate", self.rate.value()))
+        rate_row = QWidget()
+        rate_layout = QFormLayout()
+        rate_layout.setContentsMargins(0, 0, 0, 0)
+        rate_layout.addRow("Refresh Rate/Hz", self.rate)
+        if recorder is not None:
+            self.record = QCheckBox()
+            self.record.stateChanged.connect(self.record_update)
+            self.recorded = QLabel("")
+            rate_layout.addRow("Record Metadata", self.record)
+            rate_layout.addRow(self.recorded)
+        rate_row.setLayout(rate_layout)
+        self.layout.addWidget(rate_row)
+
+        # key -> (value last shown, label)
+        self.rows = {}
+        self.keys = []
+
+    def record_update(self):
+        if self.record.isChecked():
+            self.recorder.start()
+            self.recorded.setText(f"Saving to {self.recorder.directory}/{self.recorder.session}")
+        else:
+            self.recorder.stop()
+            self.recorded.setText(f"Saved {self.recorder.frames} frames")
+
+    def update_rows(self, metadata):
+        for k, v in metadata.items():
+            if k not in self.rows:
+                label = QLabel()
+                self.keys.append(k)
+                self.keys.sort(key=sort_key)
+                # After the refresh rate row
+                self.layout.insertWidget(self.keys.index(k) + 1, label)
+                self.rows[k] = (None, label)
+            last, label = self.rows[k]
+            if last is None or last != v:
+                label.setText(format_row(k, v))
+                label.show()
+                self.rows[k] = (v, label)
+        for k, (last, label) in self.rows.items():
+            if k not in metadata and last is not None:
+                label.hide()
+                self.rows[k] = (None, label)
@@ -0,0 +1,23 @@
+#!/usr/bin/python3
+
+import numpy as np
+
+
+def sort_key(k):
+    # Put Awb to the end, as they only flash up sometimes
+    return k if "Awb" not in k else f"Z{k}"
+
+
+def format_row(k, v):
+    # Print a single metadata value nicely
+    try:
+        iter(v)
+        if k == "ColourCorrectionMatrix":
+            matrix = np.around(np.reshape(v, (-1, 3)), decimals=2)
+            return f"{k}:\n{matrix}"
+        row_data = [f'{x:.2f}' if type(x) is float else f'{x}' for x in v]
+        return f"{k}: ({', '.join(row_data)})"
+    except TypeError:
+        if type(v) is float:
+            return f"{k}: {v:.2f}"
+        return f"{k}: {v}"
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+
+import queue
+import threading
+import time
+
+import numpy as np
+
+
+def lores_size_for(size, max_width=640):
+    # A lores stream for analysis, half the main stream until narrow enough to be cheap
+    while size[0] > max_width:
+        size = (size[0] // 2 & ~1, size[1] // 2 & ~1)
+    return size
+
+
+def lores_y(request):
+    # Copy of just the Y (luminance) plane of the lores stream, or None without one
+    config = request.config["lores"]
+    if config is None:
+        return None
+    w, h = config["size"]
+    if not hasattr(request, "request"):
+        # Not backed by a libcamera request (such as the fake camera's), so nothing to map
+        return request.make_array("lores")[:h, :w].copy()
+    from picamera2 import MappedArray
+    with MappedArray(request, "lores") as m:
+        return m.array[:h, :w].copy()
+
+
+class motionDetector:
+    # Frame differencing on the lores stream. post_callback hands over a frame only when
+    # the worker is free, so the camera thread never waits on the analysis. Each frame is
+    # averaged down to a coarse grid and compared with a slowly updated background, which
+    # picks up a snail creeping along where consecutive frames would barely differ.
+    def __init__(self, on_motion=None, threshold=12.0, min_area=0.002, grid=8, alpha=0.05,
+                 roi=None, cooldown=2.0):
+        # on_motion(score, timestamp) is called from the worker thread
+        self.on_motion = on_motion
+        # on_score(score, timestamp) is called from the worker thread with every frame's score,
+        # and keeps the detector scoring frames even while it is not enabled to fire
+        self.on_score = None
+        # Change in grid cell brightness (0-255) that counts as movement
+        self.threshold = threshold
+        # Fraction of the region of interest that must change
+        self.min_area = min_area
+        # Pixels per grid cell side
+        self.grid = grid
+        # How quickly the background follows the scene
+        self.alpha = alpha
+        # (x, y, w, h) as fractions of the frame, or None for all of it
+        self.roi = roi
+        # Seconds after firing before firing again
+        self.cooldown = cooldown
+        self.enabled = False
+        self.background = None
+        self.score = 0.0
+        self.last_fired = 0.0
+        self.frames = 0
+        self.skipped = 0
+        self.frames_queue = queue.Queue(maxsize=1)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        # Called from post_callback on the camera thread
+        if not self.enabled and self.on_score is None:
+            return
+        if self.frames_queue.full():
+            self.skipped += 1
+            return
+        y = lores_y(request)
+        if y is None:
+            return
+        try:
+            self.frames_queue.put_nowait((y, request.get_metadata()["SensorTimestamp"]))
+        except queue.Full:
+            self.skipped += 1
+
+    def reset(self):
+        self.background = None
+
+    def downsample(self, y):
+        g = self.grid
+        h, w = y.shape[0] // g * g, y.shape[1] // g * g
+        return y[:h, :w].reshape(h // g, g, w // g, g).mean(axis=(1, 3), dtype=np.float32)
+
+    def roi_slice(self, shape):
+        if self.roi is None:
+            return slice(None), slice(None)
+        x, y, w, h = self.roi
+        rows, cols = shape
+        return (slice(int(y * rows), max(int((y + h) * rows), int(y * rows) + 1)),
+                slice(int(x * cols), max(int((x + w) * cols), int(x * cols) + 1)))
+
+    def process(self, y, timestamp):
+        cells = self.downsample(y)
+        if self.background is None or self.background.shape != cells.shape:
+            self.background = cells
+            return 0.0
+        rows, cols = self.roi_slice(cells.shape)
+        diff = np.abs(cells[rows, cols] - self.background[rows, cols])
+        self.score = float(np.count_nonzero(diff > self.threshold)) / max(diff.size, 1)
+        # Update the background in place
+        self.background *= 1 - self.alpha
+        self.background += self.alpha * cells
+        self.frames += 1
+        if self.on_score is not None:
+            self.on_score(self.score, timestamp)
+        if not self.enabled:
+            return self.score
+        now = time.monotonic()
+        if self.score >= self.min_area and now - self.last_fired >= self.cooldown:
+            self.last_fired = now
+            if self.on_motion is not None:
+                self.on_motion(self.score, timestamp)
+        return self.score
+
+    def run(self):
+        while True:
+            y, timestamp = self.frames_queue.get()
+            try:
+                self.process(y, timestamp)
+            except Exception as e:
+                print("Motion detection failed:", e)
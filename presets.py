@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+
+import json
+import os
+import time
+
+from files import atomic_path, safe_name
+
+# Named sets of controls and still/video settings, such as for day and night
+preset_dir = os.path.join(os.path.expanduser("~"), ".config", "snailcam", "presets")
+
+
+def preset_path(name):
+    return os.path.join(preset_dir, safe_name(name) + ".json")
+
+
+def list_presets():
+    if not os.path.isdir(preset_dir):
+        return []
+    return sorted(f[:-5] for f in os.listdir(preset_dir) if f.endswith(".json"))
+
+
+def save_preset(name, preset):
+    # preset is {"controls": {...}, "still": {...}, "video": {...}}
+    os.makedirs(preset_dir, exist_ok=True)
+    with atomic_path(preset_path(name)) as tmp_path, open(tmp_path, "w") as f:
+        json.dump(preset, f, indent=1)
+
+
+def load_preset(name):
+    with open(preset_path(name)) as f:
+        preset = json.load(f)
+    preset["controls"] = {k: tuple(v) if isinstance(v, list) else v for k, v in preset.get("controls", {}).items()}
+    return preset
+
+
+def delete_preset(name):
+    try:
+        os.remove(preset_path(name))
+    except FileNotFoundError:
+        pass
+
+
+class convergenceWatch:
+    # Counts the frames after a preset is applied until the metadata shows it has taken
+    # effect. Manual exposure, gain and colour gains must be reached, the frame duration must
+    # be within its limits, and the AEC must have locked if it is on.
+    def __init__(self, controls, done=None, tolerance=0.05, max_frames=120):
+        self.controls = controls
+        # done(frames, seconds, converged) is called from the camera thread
+        self.done = done
+        self.tolerance = tolerance
+        self.max_frames = max_frames
+        self.start = time.perf_counter()
+        self.frames = 0
+        self.finished = False
+
+    def close(self, a, b):
+        return abs(a - b) <= self.tolerance * max(abs(b), 1e-6)
+
+    def converged(self, metadata):
+        c = self.controls
+        if not c.get("AeEnable", True):
+            if "ExposureTime" in c and not self.close(metadata["ExposureTime"], c["ExposureTime"]):
+                return False
+            if "AnalogueGain" in c and not self.close(metadata["AnalogueGain"], c["AnalogueGain"]):
+                return False
+        elif not metadata.get("AeLocked", True):
+            return False
+        if not c.get("AwbEnable", True) and "ColourGains" in c and "ColourGains" in metadata:
+            if not all(self.close(m, v) for m, v in zip(metadata["ColourGains"], c["ColourGains"])):
+                return False
+        if "FrameDurationLimits" in c:
+            low, high = c["FrameDurationLimits"]
+            if not low * (1 - self.tolerance) <= metadata["FrameDuration"] <= high * (1 + self.tolerance):
+                return False
+        if "FrameRate" in c and not self.close(metadata["FrameDuration"], 1e6 / c["FrameRate"]):
+            return False
+        return True
+
+    def frame(self, metadata):
+        # Called from post_callback, returning True once finished
+        if self.finished:
+            return True
+        self.frames += 1
+        converged = self.converged(metadata)
+        if converged or self.frames >= self.max_frames:
+            self.finished = True
+            if self.done is not None:
+                self.done(self.frames, time.perf_counter() - self.start, converged)
+        return self.finished
@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+
+import glob
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+# Per frame metadata that gets kept. Anything missing from a frame is left as zero.
+metadata_dtype = np.dtype([
+    ("SensorTimestamp", np.int64),
+    ("FrameDuration", np.int32),
+    ("ExposureTime", np.int32),
+    ("AnalogueGain", np.float32),
+    ("DigitalGain", np.float32),
+    ("Lux", np.float32),
+    ("ColourTemperature", np.int32),
+    ("ColourGains", np.float32, (2,)),
+    ("FocusFoM", np.int32),
+    ("LensPosition", np.float32),
+])
+
+
+class metadataRecorder:
+    # Keeps every frame's metadata in a preallocated structured array, split into two halves.
+    # post_callback writes each frame into the next free row, and when a half fills it is
+    # handed to a writer thread to save as a chunk file while the other half fills up. So
+    # appending never allocates and the camera thread never touches the disk.
+    def __init__(self, directory="metadata", chunk_frames=4096):
+        self.directory = directory
+        self.chunk_frames = chunk_frames
+        self.buffers = [np.zeros(chunk_frames, dtype=metadata_dtype) for _ in range(2)]
+        self.current = 0
+        self.index = 0
+        self.chunk = 0
+        self.frames = 0
+        self.dropped_chunks = 0
+        self.enabled = False
+        self.saving = False
+        self.session = None
+        self.fields = list(metadata_dtype.names)
+        self.lock = threading.Lock()
+        self.flush_queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def start(self, session=None):
+        # Each session gets its own subdirectory of chunk files
+        self.session = session if session else time.strftime("%Y%m%d-%H%M%S")
+        os.makedirs(os.path.join(self.directory, self.session), exist_ok=True)
+        self.index = 0
+        self.chunk = 0
+        self.frames = 0
+        self.enabled = True
+
+    def stop(self):
+        with self.lock:
+            self.enabled = False
+            self.flush()
+
+    def append(self, metadata):
+        # Called from post_callback on the camera thread
+        if not self.enabled:
+            return
+        with self.lock:
+            row = self.buffers[self.current][self.index]
+            for name in self.fields:
+                value = metadata.get(name)
+                row[name] = 0 if value is None else value
+            self.index += 1
+            self.frames += 1
+            if self.index == self.chunk_frames:
+                self.flush()
+
+    def flush(self):
+        # Hand the filled rows of the current half to the writer, and carry on in the other
+        if self.index == 0 or self.session is None:
+            return
+        if self.saving:
+            # The writer is still saving the other half, so these rows get overwritten
+            self.dropped_chunks += 1
+            print("Metadata writer behind, dropping", self.index, "frames")
+        else:
+            self.saving = True
+            buffer = self.buffers[self.current]
+            self.flush_queue.put((os.path.join(self.directory, self.session), self.chunk, buffer, self.index))
+            self.current = 1 - self.current
+            self.chunk += 1
+        self.index = 0
+
+    def run(self):
+        while True:
+            directory, chunk, buffer, count = self.flush_queue.get()
+            try:
+                np.save(os.path.join(directory, f"{chunk:08d}.npy"), buffer[:count])
+            except Exception as e:
+                print("Failed to save metadata:", e)
+            finally:
+                self.saving = False
+                self.flush_queue.task_done()
+
+
+def load_session(directory):
+    # Every frame of a recorded session as one structured array
+    chunks = sorted(glob.glob(os.path.join(directory, "*.npy")))
+    if not chunks:
+        return np.zeros(0, dtype=metadata_dtype)
+    return np.concatenate([np.load(chunk) for chunk in chunks])
+
+
+def query(directory, start=None, end=None, fields=None):
+    # Frames with start <= SensorTimestamp < end (nanoseconds), optionally only some fields.
+    # Only chunks that can overlap the range are loaded, memory mapped.
+    selected = []
+    for chunk in sorted(glob.glob(os.path.join(directory, "*.npy"))):
+        frames = np.load(chunk, mmap_mode="r")
+        if not len(frames):
+            continue
+        timestamps = frames["SensorTimestamp"]
+        if (start is not None and timestamps[-1] < start) or (end is not None and timestamps[0] >= end):
+            continue
+        mask = np.ones(len(frames), dtype=bool)
+        if start is not None:
+            mask &= timestamps >= start
+        if end is not None:
+            mask &= timestamps < end
+        selected.append(np.array(frames[mask]))
+    frames = np.concatenate(selected) if selected else np.zeros(0, dtype=metadata_dtype)
+    return frames[fields] if fields else frames
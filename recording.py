@@ -0,0 +1,616 @@
+#!/usr/bin/python3
+
+import bisect
+import json
+import os
+import threading
+import time
+from collections import deque
+
+try:
+    from picamera2.outputs import Output
+except ImportError:
+    class Output:
+        # Without picamera2 (such as with the fake camera), just what picamera2's Output does
+        # that the outputs here rely on
+        def __init__(self, pts=None):
+            self.recording = False
+
+        def start(self):
+            self.recording = True
+
+        def stop(self):
+            self.recording = False
+
+
+class clipFile:
+    # Raw H.264 straight from the encoder, with an mkvmerge style timestamp file alongside so
+    # the clip keeps its real timing when muxed
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, "wb")
+        self.pts = open(f"{os.path.splitext(filename)[0]}_pts.txt", "w")
+        self.pts.write("# timecode format v2\n")
+        self.first_timestamp = None
+        self.frames = 0
+        self.bytes = 0
+
+    def write(self, frame, timestamp):
+        if self.first_timestamp is None:
+            self.first_timestamp = timestamp
+        self.file.write(frame)
+        self.pts.write(f"{(timestamp - self.first_timestamp) / 1000:.3f}\n")
+        self.frames += 1
+        self.bytes += len(frame)
+
+    def close(self):
+        self.file.close()
+        self.pts.close()
+
+
+class eventOutput(Output):
+    # Keeps the last pre_seconds of encoded video in memory so a clip can start before
+    # whatever triggered it. Frames are held as whole GOPs, each from a keyframe, and the
+    # oldest GOP goes once the rest cover pre_seconds or max_bytes is reached, so memory
+    # stays bounded and every clip starts on a keyframe. When triggered the buffer is written
+    # out and the live stream follows, until post_seconds after the last trigger. Nothing is
+    # re-encoded and no frame is missed in between.
+    def __init__(self, directory="events", pre_seconds=5.0, post_seconds=10.0, max_bytes=64 * 2**20,
+                 on_clip=None):
+        super().__init__()
+        self.directory = directory
+        self.pre_seconds = pre_seconds
+        self.post_seconds = post_seconds
+        self.max_bytes = max_bytes
+        # on_clip(filename, frames, bytes, reason) is called from the encoder thread once a clip ends
+        self.on_clip = on_clip
+        self.lock = threading.Lock()
+        # Lists of (frame, keyframe, timestamp in us), each starting at a keyframe
+        self.gops = deque()
+        self.buffered_bytes = 0
+        self.last_timestamp = None
+        self.clip = None
+        self.clip_reason = None
+        self.clip_until = 0
+        self.clips = 0
+        self.triggers = 0
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        super().start()
+
+    def stop(self):
+        super().stop()
+        with self.lock:
+            self.end_clip()
+            self.gops.clear()
+            self.buffered_bytes = 0
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        # Called from the encoder thread with each encoded frame
+        if timestamp is None:
+            timestamp = time.monotonic_ns() // 1000
+        # The encoder reuses its buffers, so anything kept has to be copied
+        frame = bytes(frame)
+        with self.lock:
+            self.last_timestamp = timestamp
+            if self.clip is not None:
+                self.clip.write(frame, timestamp)
+                if timestamp >= self.clip_until:
+                    self.end_clip()
+                return
+            if keyframe:
+                self.gops.append([])
+            elif not self.gops:
+                # Nothing to decode this against
+                return
+            self.gops[-1].append((frame, keyframe, timestamp))
+            self.buffered_bytes += len(frame)
+            self.trim()
+
+    def trim(self):
+        # Drop whole GOPs from the front while the rest still cover pre_seconds
+        while len(self.gops) > 1 and (
+            self.last_timestamp - self.gops[1][0][2] >= self.pre_seconds * 1e6
+            or self.buffered_bytes > self.max_bytes
+        ):
+            gop = self.gops.popleft()
+            self.buffered_bytes -= sum(len(f) for f, _, _ in gop)
+
+    @property
+    def buffered_seconds(self):
+        with self.lock:
+            if not self.gops or self.last_timestamp is None:
+                return 0.0
+            return (self.last_timestamp - self.gops[0][0][2]) / 1e6
+
+    @property
+    def clip_active(self):
+        # Whether a clip is being written, as opposed to the output running at all
+        return self.clip is not None
+
+    def trigger(self, reason="api"):
+        # Start a clip, or keep the current one going for longer. Safe from any thread.
+        with self.lock:
+            self.triggers += 1
+            if self.last_timestamp is None:
+                print("Event", reason, "before any video, ignoring")
+                return None
+            self.clip_until = self.last_timestamp + self.post_seconds * 1e6
+            if self.clip is not None:
+                return self.clip.filename
+            os.makedirs(self.directory, exist_ok=True)
+            filename = os.path.join(self.directory, f"event_{time.strftime('%Y%m%d-%H%M%S')}_{reason}.h264")
+            self.clip = clipFile(filename)
+            self.clip_reason = reason
+            for gop in self.gops:
+                for frame, _, timestamp in gop:
+                    self.clip.write(frame, timestamp)
+            self.gops.clear()
+            self.buffered_bytes = 0
+            print("Event", reason, "recording", filename)
+            return filename
+
+    def end_clip(self):
+        if self.clip is None:
+            return
+        clip, self.clip = self.clip, None
+        clip.close()
+        self.clips += 1
+        print(f"Event clip {clip.filename}: {clip.frames} frames, {clip.bytes / 2**20:.1f}MB")
+        if self.on_clip is not None:
+            self.on_clip(clip.filename, clip.frames, clip.bytes, self.clip_reason)
+
+
+def sensor_start(encoder):
+    # SensorTimestamp // 1000 of the first frame the encoder encoded, or None before that.
+    # Encoders hand their outputs timestamps in us from that frame, not SensorTimestamps.
+    return getattr(encoder, "firsttimestamp", None) if encoder is not None else None
+
+
+class segmentedOutput(Output):
+    # Writes one long recording as a run of files, starting a new one at the first keyframe
+    # after segment_seconds or segment_bytes, so the encoder never stops and no frame is lost.
+    # Each finished segment gets a line in an index file (name_segments.jsonl) saying where it
+    # starts and how big it is, so the archive can be found without opening every file. Given
+    # the encoder, start and end are SensorTimestamp // 1000, to match the metadata; without
+    # it they are us from the start of the recording.
+    def __init__(self, name="test", segment_seconds=600.0, segment_bytes=None, on_segment=None, encoder=None):
+        super().__init__()
+        self.encoder = encoder
+        self.name = name
+        self.segment_seconds = segment_seconds
+        self.segment_bytes = segment_bytes
+        # on_segment(entry) is called from the encoder thread as each segment is finished
+        self.on_segment = on_segment
+        self.index_path = f"{name}_segments.jsonl"
+        self.lock = threading.Lock()
+        self.segment = None
+        self.segment_start = None
+        self.last_timestamp = None
+        self.segments = 0
+
+    def start(self):
+        directory = os.path.dirname(self.name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Carry on numbering after an earlier recording of the same name
+        if os.path.exists(self.index_path):
+            self.segments = len(load_segments(self.index_path))
+        super().start()
+
+    def stop(self):
+        super().stop()
+        with self.lock:
+            self.end_segment()
+
+    def due(self, timestamp):
+        if self.segment_seconds and timestamp - self.segment_start >= self.segment_seconds * 1e6:
+            return True
+        return bool(self.segment_bytes) and self.segment.bytes >= self.segment_bytes
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        # Called from the encoder thread with each encoded frame
+        if timestamp is None:
+            timestamp = time.monotonic_ns() // 1000
+        with self.lock:
+            if keyframe and (self.segment is None or self.due(timestamp)):
+                self.end_segment()
+                self.segment = clipFile(f"{self.name}_{self.segments:05d}.h264")
+                self.segment_start = timestamp
+            if self.segment is not None:
+                self.segment.write(frame, timestamp)
+                self.last_timestamp = timestamp
+
+    def end_segment(self):
+        if self.segment is None:
+            return
+        segment, self.segment = self.segment, None
+        segment.close()
+        offset = sensor_start(self.encoder) or 0
+        entry = {
+            "index": self.segments,
+            "filename": os.path.basename(segment.filename),
+            "start": self.segment_start + offset,
+            "end": self.last_timestamp + offset,
+            "frames": segment.frames,
+            "bytes": segment.bytes,
+        }
+        with open(self.index_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+        self.segments += 1
+        if self.on_segment is not None:
+            self.on_segment(entry)
+
+
+def load_segments(index_path):
+    # Every segment recorded so far, in order
+    with open(index_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_segment(index_path, timestamp):
+    # The segment holding timestamp, in the units the index was written in (SensorTimestamp
+    # // 1000 for recordings from the app), or None
+    for entry in load_segments(index_path):
+        if entry["start"] <= timestamp <= entry["end"]:
+            return entry
+    return None
+
+
+class indexOutput(Output):
+    # Goes alongside the real output in the encoder's output list and writes a sidecar index
+    # of every keyframe, with its byte offset in the H.264 stream and its time, plus markers
+    # for events such as motion or detections. A player or ffmpeg can then start at the
+    # keyframe before a moment of interest instead of decoding everything up to it.
+    # Times in the index are us from the start of the recording, as the encoder gives them.
+    # The first line records the first frame's SensorTimestamp // 1000, taken from the
+    # encoder, so events from the metadata can be placed on the same clock.
+    # The offsets are exact for raw .h264 files; in an mp4 the muxer moves things about, so
+    # there seek by the seconds from the start of the recording instead.
+    def __init__(self, filename, encoder=None):
+        super().__init__()
+        self.filename = filename
+        self.encoder = encoder
+        self.lock = threading.Lock()
+        self.file = None
+        self.offset = 0
+        self.frames = 0
+        self.sensor_start = None
+        self.last_timestamp = None
+        self.keyframes = 0
+        self.events = 0
+
+    def start(self):
+        with self.lock:
+            self.file = open(self.filename, "w")
+        super().start()
+
+    def stop(self):
+        super().stop()
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def write(self, entry):
+        if self.file is not None:
+            self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        # Called from the encoder thread with each encoded frame
+        if timestamp is None:
+            timestamp = time.monotonic_ns() // 1000
+        with self.lock:
+            if not self.frames:
+                self.sensor_start = sensor_start(self.encoder)
+                self.write({"s": self.sensor_start})
+            if keyframe:
+                self.write({"k": self.frames, "o": self.offset, "t": timestamp})
+                self.keyframes += 1
+            self.offset += len(frame)
+            self.frames += 1
+            self.last_timestamp = timestamp
+
+    def mark(self, reason, timestamp=None):
+        # Record an event at timestamp (us, as SensorTimestamp // 1000), or at the latest frame.
+        # Safe from any thread.
+        with self.lock:
+            if self.file is None or self.last_timestamp is None:
+                return
+            if timestamp is None:
+                timestamp = self.last_timestamp
+            elif self.sensor_start is not None:
+                timestamp -= self.sensor_start
+            else:
+                # No way to put it on the recording's clock
+                return
+            self.write({"e": reason, "t": timestamp})
+            self.events += 1
+
+
+def index_path(filename):
+    # Where the index of a recording goes
+    return f"{os.path.splitext(filename)[0]}_index.jsonl"
+
+
+class recordingIndex:
+    # Reads back what indexOutput wrote, to find where in a recording to start decoding.
+    # Timestamps are us from the start of the recording unless they say otherwise.
+    def __init__(self, filename):
+        self.keyframes = []
+        self.events = []
+        self.sensor_start = None
+        with open(filename) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if "k" in entry:
+                    self.keyframes.append((entry["t"], entry["o"], entry["k"]))
+                elif "e" in entry:
+                    self.events.append((entry["t"], entry["e"]))
+                elif "s" in entry:
+                    self.sensor_start = entry["s"]
+        self.times = [t for t, _, _ in self.keyframes]
+
+    @property
+    def start(self):
+        return self.times[0] if self.times else None
+
+    def seek(self, timestamp):
+        # The last keyframe at or before timestamp as {"timestamp", "offset", "frame",
+        # "seconds"}, seconds being from the start of the recording, or None if before it
+        i = bisect.bisect_right(self.times, timestamp) - 1
+        if i < 0:
+            return None
+        t, offset, frame = self.keyframes[i]
+        return {"timestamp": t, "offset": offset, "frame": frame, "seconds": (t - self.start) / 1e6}
+
+    def seek_sensor(self, timestamp):
+        # As seek, for a SensorTimestamp // 1000 such as from the frame metadata
+        if self.sensor_start is None:
+            return None
+        return self.seek(timestamp - self.sensor_start)
+
+    def find_events(self, reason=None):
+        # Events in order, each with where to start decoding to see it
+        return [
+            {"timestamp": t, "reason": r, "keyframe": self.seek(t)}
+            for t, r in self.events if reason is None or r == reason
+        ]
+
+
+def set_encoder_bitrate(encoder, bitrate):
+    # Change the bitrate of a running encoder. The Pi's V4L2 H.264 encoder takes a new
+    # bitrate between frames; anything else (such as the fake encoder) just reads the
+    # attribute. Returns whether the running encoder was told.
+    encoder.bitrate = bitrate
+    vd = getattr(encoder, "vd", None)
+    if vd is None:
+        return False
+    try:
+        import fcntl
+        from picamera2.encoders import v4l2_encoder as v4l2
+        ctrl = v4l2.v4l2_control()
+        ctrl.id = v4l2.V4L2_CID_MPEG_VIDEO_BITRATE
+        ctrl.value = int(bitrate)
+        fcntl.ioctl(vd, v4l2.VIDIOC_S_CTRL, ctrl)
+        return True
+    except Exception as e:
+        print("Could not change the encoder bitrate:", e)
+        return False
+
+
+class adaptiveBitrate(Output):
+    # Drives the encoder bitrate from the motion score of the lores stream, between
+    # min_bitrate for a still scene and max_bitrate once full_motion of it is changing.
+    # The level jumps up as soon as something moves and eases back down, so the start of
+    # a movement gets the bits. It sits in the encoder's output list to measure what the
+    # encoder actually produced, and logs the bitrate against the motion to a CSV file
+    # every interval seconds.
+    def __init__(self, encoder, min_bitrate=1_000_000, max_bitrate=10_000_000, full_motion=0.02,
+                 fall=0.02, interval=1.0, log=None):
+        super().__init__()
+        self.encoder = encoder
+        self.min_bitrate = min_bitrate
+        self.max_bitrate = max_bitrate
+        # Motion score (fraction of the scene changing) that gets the full bitrate
+        self.full_motion = full_motion
+        # Fraction of the way the level falls towards a lower score with each score
+        self.fall = fall
+        self.interval = interval
+        self.log = log
+        self.lock = threading.Lock()
+        self.log_file = None
+        self.level = 1.0
+        self.bitrate = max_bitrate
+        self.score_sum = 0.0
+        self.scores = 0
+        self.changes = 0
+        # Encoded bytes and stream time in this interval, and over the whole recording
+        self.interval_start = None
+        self.interval_bytes = 0
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.bytes = 0
+
+    def start(self):
+        set_encoder_bitrate(self.encoder, self.bitrate)
+        if self.log is not None:
+            self.log_file = open(self.log, "w")
+            self.log_file.write("seconds,motion,level,bitrate,actual_bitrate\n")
+        super().start()
+
+    def stop(self):
+        super().stop()
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+        summary = self.summary
+        if summary is not None:
+            print(
+                f"Adaptive bitrate: {summary['mb_per_hour']:.0f}MB/hour against {summary['max_mb_per_hour']:.0f}MB/hour"
+                f" at the maximum, {summary['saved'] * 100:.0f}% saved, {self.changes} changes"
+            )
+
+    def update(self, score, timestamp=None):
+        # Called by the motion detector with each frame's score
+        level = min(score / self.full_motion, 1.0) if self.full_motion > 0 else 1.0
+        with self.lock:
+            if level > self.level:
+                self.level = level
+            else:
+                self.level += self.fall * (level - self.level)
+            self.score_sum += score
+            self.scores += 1
+
+    def target(self, level):
+        return int(self.min_bitrate + (self.max_bitrate - self.min_bitrate) * level)
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        # Called from the encoder thread with each encoded frame
+        if timestamp is None:
+            timestamp = time.monotonic_ns() // 1000
+        with self.lock:
+            if self.first_timestamp is None:
+                self.first_timestamp = self.interval_start = timestamp
+            self.last_timestamp = timestamp
+            self.bytes += len(frame)
+            self.interval_bytes += len(frame)
+            elapsed = (timestamp - self.interval_start) / 1e6
+            if elapsed < self.interval:
+                return
+            motion = self.score_sum / self.scores if self.scores else 0.0
+            level = self.level
+            bitrate = self.target(level)
+            actual = self.interval_bytes * 8 / elapsed
+            if self.log_file is not None:
+                self.log_file.write(
+                    f"{(timestamp - self.first_timestamp) / 1e6:.3f},{motion:.5f},{level:.3f},{self.bitrate},{actual:.0f}\n"
+                )
+            self.interval_start = timestamp
+            self.interval_bytes = 0
+            self.score_sum = 0.0
+            self.scores = 0
+            # Small changes are not worth disturbing the encoder's rate control for
+            change = abs(bitrate - self.bitrate) > 0.05 * self.bitrate
+            if change:
+                self.bitrate = bitrate
+                self.changes += 1
+        if change:
+            set_encoder_bitrate(self.encoder, bitrate)
+
+    @property
+    def summary(self):
+        # Storage per hour so far, against what max_bitrate throughout would have used
+        with self.lock:
+            if self.first_timestamp is None or self.last_timestamp == self.first_timestamp:
+                return None
+            hours = (self.last_timestamp - self.first_timestamp) / 3.6e9
+            mb_per_hour = self.bytes / 2**20 / hours
+            max_mb_per_hour = self.max_bitrate / 8 * 3600 / 2**20
+            return {
+                "hours": hours,
+                "mb_per_hour": mb_per_hour,
+                "max_mb_per_hour": max_mb_per_hour,
+                "saved": max(1 - mb_per_hour / max_mb_per_hour, 0.0),
+                "bitrate": self.bitrate,
+            }
+
+
+class activityFrameRate(Output):
+    # Runs the camera at idle_rate while nothing is happening and at full_rate from the
+    # moment there is motion or a detection until idle_after seconds after the last of it,
+    # which turns hours of a still scene into something like a time-lapse. It sits in the
+    # encoder's output list to count what was encoded; every frame keeps its sensor
+    # timestamp, so the output needs to keep those (a pts file for raw H.264) for the
+    # video to play back at the right speed.
+    def __init__(self, set_rate, full_rate=30.0, idle_rate=1.0, idle_after=10.0, min_area=0.002):
+        super().__init__()
+        # set_rate(fps) changes the camera frame rate, from any thread
+        self.set_rate = set_rate
+        self.full_rate = full_rate
+        self.idle_rate = idle_rate
+        self.idle_after = idle_after
+        # Motion score that counts as activity
+        self.min_area = min_area
+        self.lock = threading.Lock()
+        self.fast = True
+        self.last_activity = time.monotonic()
+        self.last_timestamp = None
+        self.frames = 0
+        self.bytes = 0
+        self.skipped = 0
+        self.idle_frames = 0
+        self.switches = 0
+
+    def start(self):
+        with self.lock:
+            self.last_activity = time.monotonic()
+            self.fast = True
+        self.set_rate(self.full_rate)
+        super().start()
+
+    def stop(self):
+        super().stop()
+        # Leave the camera as it was found
+        self.set_rate(self.full_rate)
+        print(
+            f"Activity frame rate: {self.frames} frames encoded, {self.skipped} skipped,"
+            f" about {self.saved_bytes / 2**20:.1f}MB saved"
+        )
+
+    def activity(self, reason=None):
+        # Something happened, so go to full rate now. Safe from any thread.
+        with self.lock:
+            self.last_activity = time.monotonic()
+            if self.fast:
+                return
+            self.fast = True
+            self.switches += 1
+        self.set_rate(self.full_rate)
+
+    def update(self, score, timestamp=None):
+        # Called by the motion detector with each frame's score
+        if score >= self.min_area:
+            self.activity("motion")
+
+    def outputframe(self, frame, keyframe=True, timestamp=None, *args, **kwargs):
+        # Called from the encoder thread with each encoded frame
+        if timestamp is None:
+            timestamp = time.monotonic_ns() // 1000
+        with self.lock:
+            if self.last_timestamp is not None:
+                # Frames full_rate would have given in the time since the last one
+                self.skipped += max(int(round((timestamp - self.last_timestamp) * self.full_rate / 1e6)) - 1, 0)
+            self.last_timestamp = timestamp
+            self.frames += 1
+            self.bytes += len(frame)
+            if not self.fast:
+                self.idle_frames += 1
+            idle = self.fast and time.monotonic() - self.last_activity > self.idle_after
+            if idle:
+                self.fast = False
+                self.switches += 1
+        if idle:
+            self.set_rate(self.idle_rate)
+
+    @property
+    def saved_bytes(self):
+        # An estimate, taking each skipped frame as the size of the average encoded one
+        return self.skipped * self.bytes / self.frames if self.frames else 0
+
+    @property
+    def stats(self):
+        with self.lock:
+            return {
+                "frames": self.frames,
+                "skipped": self.skipped,
+                "idle_frames": self.idle_frames,
+                "switches": self.switches,
+                "bytes": self.bytes,
+                "saved_bytes": int(self.saved_bytes),
+                "fast": self.fast,
+            }
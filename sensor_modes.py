@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+
+import importlib.metadata
+import json
+import os
+import time
+
+from files import atomic_path, safe_name
+
+# Enumerating the sensor modes restarts the camera in each of them, which takes seconds, so the
+# result is kept here per camera model and library version
+mode_dir = os.path.join(os.path.expanduser("~"), ".cache", "snailcam", "sensor_modes")
+# Fields of a mode that are kept, besides the format
+mode_fields = ["unpacked", "bit_depth", "size", "fps", "crop_limits", "exposure_limits"]
+
+
+def library_versions():
+    # Versions of picamera2 and libcamera, either of which could change what the modes are
+    versions = {}
+    try:
+        versions["picamera2"] = importlib.metadata.version("picamera2")
+    except importlib.metadata.PackageNotFoundError:
+        versions["picamera2"] = None
+    try:
+        import libcamera
+        versions["libcamera"] = libcamera.CameraManager.singleton().version
+    except Exception:
+        versions["libcamera"] = None
+    return versions
+
+
+def mode_key(picam2):
+    properties = picam2.camera_properties
+    size = properties.get("PixelArraySize", ("", ""))
+    versions = library_versions()
+    return safe_name(f"{properties.get('Model')}_{size[0]}x{size[1]}_{versions['picamera2']}_{versions['libcamera']}")
+
+
+def mode_path(key):
+    return os.path.join(mode_dir, f"{key}.json")
+
+
+def to_json(mode):
+    saved = {k: mode[k] for k in mode_fields if k in mode}
+    saved["format"] = mode["format"].format
+    return saved
+
+
+def from_json(saved, sensor_format):
+    mode = {k: tuple(v) if isinstance(v, list) else v for k, v in saved.items()}
+    mode["format"] = sensor_format(saved["format"])
+    return mode
+
+
+def load_sensor_modes(picam2, sensor_format=None):
+    # Give picam2 its sensor modes from the cache if there, enumerating and saving them if not.
+    # sensor_format makes the "format" entries (picamera2's SensorFormat unless given).
+    # Returns whether the cache was used.
+    if sensor_format is None:
+        from picamera2.sensor_format import SensorFormat as sensor_format
+    path = mode_path(mode_key(picam2))
+    try:
+        with open(path) as f:
+            picam2.sensor_modes_ = [from_json(mode, sensor_format) for mode in json.load(f)]
+        return True
+    except FileNotFoundError:
+        pass
+    except (ValueError, KeyError, TypeError) as e:
+        print("Ignoring unreadable sensor mode cache", path, e)
+    start = time.perf_counter()
+    modes = picam2.sensor_modes
+    print(f"Enumerated {len(modes)} sensor modes in {time.perf_counter() - start:.2f}s")
+    os.makedirs(mode_dir, exist_ok=True)
+    with atomic_path(path) as tmp_path, open(tmp_path, "w") as f:
+        json.dump([to_json(mode) for mode in modes], f, indent=1)
+    return False
+
+
+def clear_sensor_modes(picam2):
+    # Forget the cached modes, such as after a camera is swapped for one of the same model
+    try:
+        os.remove(mode_path(mode_key(picam2)))
+    except FileNotFoundError:
+        pass
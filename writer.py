@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class writerPool:
+    # Encodes and writes captures on background threads. Everything needed is copied out of
+    # the request first, so it goes straight back to the camera rather than being held while
+    # a JPEG or DNG is encoded. At most max_pending files can be waiting, after which
+    # submitting blocks until one has been written.
+    def __init__(self, picam2, workers=3, max_pending=6, history=50):
+        self.picam2 = picam2
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix="writer")
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.written = 0
+        self.failed = 0
+        # (filename, seconds from submit to written) of the most recent files
+        self.latencies = deque(maxlen=history)
+
+    @property
+    def stats(self):
+        with self.lock:
+            latencies = [t for _, t in self.latencies]
+            return {
+                "pending": self.pending,
+                "written": self.written,
+                "failed": self.failed,
+                "last_latency": latencies[-1] if latencies else None,
+                "mean_latency": sum(latencies) / len(latencies) if latencies else None,
+            }
+
+    def submit(self, write, filename, done=None):
+        # Queue write() to run in the background, blocking while the queue is full
+        self.slots.acquire()
+        with self.lock:
+            self.pending += 1
+        submitted = time.perf_counter()
+
+        def run():
+            # done(filename, latency) is only called for files that were written
+            try:
+                write()
+            except Exception as e:
+                print("Failed to write", filename, e)
+                with self.lock:
+                    self.failed += 1
+                return
+            finally:
+                with self.lock:
+                    self.pending -= 1
+                self.slots.release()
+            latency = time.perf_counter() - submitted
+            with self.lock:
+                self.written += 1
+                self.latencies.append((filename, latency))
+            if done is not None:
+                done(filename, latency)
+
+        return self.executor.submit(run)
+
+    def write_request(self, request, outputs, done=None):
+        # outputs maps stream names ("main", "lores", "raw") to filenames. The raw stream is
+        # written as a DNG, the others as whatever image format the filename asks for. Each
+        # file is written in parallel, and the request is released before this returns.
+        helpers = self.picam2.helpers
+        metadata = request.get_metadata()
+        copies = {}
+        try:
+            for name in outputs:
+                copies[name] = (request.make_buffer(name), request.config[name])
+        finally:
+            request.release()
+        futures = []
+        for name, filename in outputs.items():
+            buffer, config = copies[name]
+            if name == "raw":
+                def write(buffer=buffer, config=config, filename=filename):
+                    helpers.save_dng(buffer, metadata, config, filename)
+            elif config["format"] == "YUV420":
+                # The lores stream, which PIL can't make an image from
+                def write(buffer=buffer, config=config, filename=filename):
+                    import cv2
+                    cv2.imwrite(filename, cv2.cvtColor(helpers.make_array(buffer, config), cv2.COLOR_YUV420p2BGR))
+            else:
+                def write(buffer=buffer, config=config, filename=filename):
+                    helpers.save(helpers.make_image(buffer, config), metadata, filename)
+            futures.append(self.submit(write, filename, done))
+        return futures
+
+    def write_array(self, array, filename, done=None):
+        # Write an already made BGR array, as produced by OpenCV
+        def write():
+            import cv2
+            cv2.imwrite(filename, array)
+
+        return self.submit(write, filename, done)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
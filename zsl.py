@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+
+import threading
+import time
+from collections import deque
+
+
+class zslRing:
+    # Zero shutter lag. Keeps hold of the most recent full resolution requests while the
+    # camera runs in a still capable configuration, so pressing the shutter hands back a
+    # frame the camera has already captured instead of reconfiguring and waiting for a new
+    # one. The configuration needs size + 2 buffers, so the preview always has some spare.
+    def __init__(self, picam2, size=3):
+        self.picam2 = picam2
+        self.size = size
+        self.ring = deque()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.running = False
+        # Set by the GUI when the still configuration should keep the ring filled
+        self.enabled = False
+
+    @property
+    def buffer_count(self):
+        return self.size + 2
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        # Must be called before the camera is stopped, as the thread waits on new frames
+        if not self.running:
+            return
+        self.running = False
+        self.thread.join()
+        with self.lock:
+            while self.ring:
+                self.ring.popleft().release()
+
+    def run(self):
+        while self.running:
+            request = self.picam2.capture_request()
+            with self.lock:
+                self.ring.append(request)
+                if len(self.ring) > self.size:
+                    self.ring.popleft().release()
+
+    def take(self, trigger=None):
+        # Returns the request whose SensorTimestamp is closest to trigger (time.monotonic_ns(),
+        # the same clock the camera uses), or None if the ring is empty. The caller owns the
+        # request and must release it.
+        if trigger is None:
+            trigger = time.monotonic_ns()
+        with self.lock:
+            if not self.ring:
+                return None
+            best = min(self.ring, key=lambda r: abs(r.get_metadata()["SensorTimestamp"] - trigger))
+            self.ring.remove(best)
+        lag = (best.get_metadata()["SensorTimestamp"] - trigger) / 1e6
+        print(f"ZSL frame is {lag:+.1f}ms from the shutter press")
+        return best